@@ -0,0 +1,106 @@
+# Micro-benchmark of the juggler's song queue, against the plain list it
+# replaced. Run with: python3 benchmarks/bench_queue.py [tracks]
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from songqueue import SongQueue
+
+# The list based queue, as mp3Juggler used to do it
+class ListQueue:
+    def __init__(self):
+        self._songlist = []
+
+    def insert(self, song):
+        index = 0
+        if len(self._songlist) > 0:
+            index = 1
+            for item in self._songlist[1:]:
+                if(item['prio']>song['prio']):
+                    break
+                index+= 1
+        self._songlist.insert(index, song)
+        return index
+
+    def by_upload(self, upload_id):
+        for song in reversed(self._songlist):
+            if song.get('upload_id') == upload_id:
+                return song
+        return None
+
+    def get(self, track_id):
+        for song in self._songlist:
+            if song['id'] == track_id:
+                return song
+        return None
+
+    def remove(self, song):
+        self._songlist.remove(song)
+
+    def __iter__(self):
+        return iter(self._songlist)
+
+def make_songs(count, addresses):
+    counts = {}
+    songs = []
+    for i in range(count):
+        address = random.choice(addresses)
+        counts[address] = counts.get(address, 0) + 1
+        songs.append({
+            'id': str(uuid.uuid4()),
+            'type': random.choice(('file', 'link')),
+            'upload_id': 'upload-%d' % i,
+            'address': address,
+            'prio': max(counts[address] - 3, 0)
+        })
+    return songs
+
+def run(queue, songs):
+    timings = {}
+    start = time.perf_counter()
+    for i, song in enumerate(songs):
+        if i > 0:
+            queue.by_upload(songs[i - 1]['upload_id'])
+        queue.insert(song)
+    timings['insert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for song in songs:
+        queue.get(song['id'])
+    timings['lookup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for song in songs[1:]:
+        queue.remove(song)
+    timings['cancel'] = time.perf_counter() - start
+    return timings
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    random.seed(1)
+    songs = make_songs(count, ['10.0.0.%d' % i for i in range(50)])
+
+    # Both must agree on the order before timing means anything
+    new, old = SongQueue(), ListQueue()
+    for song in songs:
+        if new.insert(song) != old.insert(song):
+            raise Exception('Queues disagree on insert position')
+    if [song['id'] for song in new] != [song['id'] for song in old]:
+        raise Exception('Queues disagree on order')
+    for song in songs[::2]:
+        new.remove(song)
+        if new.links(3) != [song for song in new if song['type'] == 'link'][:3]:
+            raise Exception('SongQueue.links disagrees with the order')
+
+    print('%d tracks' % count)
+    old_timings = run(ListQueue(), songs)
+    new_timings = run(SongQueue(), songs)
+    for name in old_timings:
+        print('  %-8s list: %8.2f ms   SongQueue: %8.2f ms' % (
+            name,
+            old_timings[name]*1000,
+            new_timings[name]*1000
+        ))
@@ -0,0 +1,235 @@
+# Load test of a headless server. Starts main.py --simulate in a subprocess,
+# connects N websocket clients, submits M uploads and L links at once, lets
+# the queue play for a while and reports enqueue throughput, latency from
+# submission until each client saw the track, server memory per client and
+# track transition gaps. Results are saved as JSON; pass an earlier result
+# with --compare to see what changed. --format and --compression pick the
+# websocket wire format and permessage-deflate level, to compare bytes sent.
+#
+#   python3 benchmarks/bench_server.py --clients 200 --uploads 10 --links 50
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+import tornado.httpclient
+import tornado.websocket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def rss(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)]
+    return {
+        'p50': pick(0.5) * 1000,
+        'p90': pick(0.9) * 1000,
+        'p99': pick(0.99) * 1000,
+        'max': values[-1] * 1000
+    }
+
+def scrape(text, name):
+    match = re.search(r'^%s (\S+)$' % re.escape(name), text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+def scrape_sum(text, name, **labels):
+    total = 0.0
+    for match in re.finditer(r'^%s\{(.*)\} (\S+)$' % re.escape(name), text, re.MULTILINE):
+        found = dict(re.findall(r'(\w+)="([^"]*)"', match.group(1)))
+        if all(found.get(key) == value for key, value in labels.items()):
+            total+= float(match.group(2))
+    return total
+
+class Client:
+    def __init__(self, port, format):
+        self.url = 'ws://127.0.0.1:%d/ws?format=%s' % (port, format)
+        self.seen = {}      # Track filename -> time.monotonic() of its insert
+        self.messages = 0
+
+    async def connect(self, compression):
+        self.ws = await tornado.websocket.websocket_connect(
+            self.url,
+            compression_options={} if compression else None
+        )
+
+    async def listen(self):
+        while True:
+            message = await self.ws.read_message()
+            if message is None:
+                break
+            self.messages+= 1
+            parsed = json.loads(message)
+            if parsed['type'] == 'insert':
+                self.seen.setdefault(parsed['item']['filename'], time.monotonic())
+            elif 'rows' in parsed:
+                # Compact lists and inserts
+                column = parsed['columns'].index('filename')
+                for row in parsed['rows']:
+                    self.seen.setdefault(row[column], time.monotonic())
+            elif parsed['type'] == 'inserts':
+                for insert in parsed['items']:
+                    self.seen.setdefault(insert['item']['filename'], time.monotonic())
+            elif parsed['type'] == 'list':
+                for item in parsed['list']:
+                    self.seen.setdefault(item['filename'], time.monotonic())
+
+async def upload(port, name, size, submitted):
+    client = tornado.httpclient.AsyncHTTPClient()
+    submitted[name] = time.monotonic()
+    await client.fetch(
+        'http://127.0.0.1:%d/upload' % port,
+        method='PUT',
+        body=os.urandom(size),
+        headers={
+            'Filename': name,
+            'Nick': 'bench',
+            'Upload-Id': 'bench:%s:%f' % (name, random.random()),
+            'Content-Type': 'audio/mpeg'
+        },
+        request_timeout=600
+    )
+
+async def wait_for_server(port, timeout=60):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.fetch('http://127.0.0.1:%d/metrics' % port)
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+async def bench(args, server):
+    await wait_for_server(args.port)
+    http = tornado.httpclient.AsyncHTTPClient()
+    baseline = rss(server.pid)
+
+    clients = [Client(args.port, args.format) for i in range(args.clients)]
+    await asyncio.gather(*[client.connect(args.compression > 0) for client in clients])
+    await asyncio.sleep(1)
+    per_client = (rss(server.pid) - baseline) / max(args.clients, 1)
+    listeners = [asyncio.ensure_future(client.listen()) for client in clients]
+
+    submitted = {}
+    start = time.monotonic()
+    jobs = []
+    for i in range(args.uploads):
+        jobs.append(upload(args.port, 'bench-%d.mp3' % i, args.upload_size, submitted))
+    for i in range(args.links):
+        link = 'http://bench.invalid/%d' % i
+        submitted[link] = time.monotonic()
+        clients[i % len(clients)].ws.write_message(json.dumps({
+            'type': 'link',
+            'id': 'bench:%d:%f' % (i, random.random()),
+            'nick': 'bench',
+            'link': link
+        }))
+    await asyncio.gather(*jobs)
+
+    # Wait until every client has seen every track
+    deadline = time.monotonic() + args.timeout
+    while any(len(client.seen) < len(submitted) for client in clients):
+        if time.monotonic() > deadline:
+            print('Timed out waiting for clients to see all tracks')
+            break
+        await asyncio.sleep(0.05)
+    enqueued = time.monotonic()
+
+    latencies = []
+    for client in clients:
+        for name, seen in client.seen.items():
+            if name in submitted:
+                latencies.append(seen - submitted[name])
+
+    await asyncio.sleep(args.play_seconds)
+    text = (await http.fetch('http://127.0.0.1:%d/metrics' % args.port)).body.decode()
+    for client in clients:
+        client.ws.close()
+    await asyncio.gather(*listeners, return_exceptions=True)
+
+    gaps = scrape(text, 'mp3printer_transition_gap_seconds_count')
+    fanouts = scrape(text, 'mp3printer_fanout_seconds_count')
+    return {
+        'config': vars(args),
+        'enqueue_per_second': len(submitted) / max(enqueued - start, 0.001),
+        'latency_ms': percentiles(latencies),
+        'rss_per_client_bytes': per_client,
+        'messages_per_client': sum(client.messages for client in clients) / len(clients),
+        'fanout_avg_ms': scrape(text, 'mp3printer_fanout_seconds_sum') / max(fanouts, 1) * 1000,
+        'payload_bytes_per_client': scrape_sum(text, 'mp3printer_sent_bytes', stage='payload') / len(clients),
+        'wire_bytes_per_client': scrape_sum(text, 'mp3printer_sent_bytes', stage='wire') / len(clients),
+        'transitions': gaps,
+        'transition_gap_avg_ms': scrape(text, 'mp3printer_transition_gap_seconds_sum') / max(gaps, 1) * 1000
+    }
+
+def flatten(result, prefix=''):
+    flat = {}
+    for key, value in result.items():
+        if key == 'config':
+            continue
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def compare(old, new):
+    old, new = flatten(old), flatten(new)
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            print('  %-32s %12.2f -> %12.2f  (%+.1f%%)' % (key, old[key], new[key], change))
+        else:
+            print('  %-32s %12s -> %12.2f' % (key, '-', new[key]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test a simulated mp3 printer')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--uploads', type=int, default=10)
+    parser.add_argument('--upload-size', type=int, default=4*1024*1024)
+    parser.add_argument('--links', type=int, default=50)
+    parser.add_argument('--track-seconds', type=float, default=1)
+    parser.add_argument('--play-seconds', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--format', type=str, default='json', choices=('json', 'compact'))
+    parser.add_argument('--compression', type=int, default=0)
+    parser.add_argument('--output', type=str, default='bench_output.json')
+    parser.add_argument('--compare', type=str, default=None)
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [sys.executable, 'main.py', '--simulate', str(args.track_seconds),
+            '--max-queued', '0', '--workers', str(args.workers), '--ws-compression', str(args.compression), '--bind', '127.0.0.1', str(args.port)],
+        cwd=ROOT,
+        stdin=subprocess.PIPE
+    )
+    try:
+        result = asyncio.run(bench(args, server))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    print(json.dumps(result, indent=2))
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print('Compared to %s:' % args.compare)
+            compare(json.load(f), result)
@@ -1,30 +1,218 @@
 from threading import Lock
-import json
+import itertools
+import time
+import tornado.websocket
+
+# local libs
+import metrics
+from wire import Encodings
+
+FANOUT_SECONDS = metrics.histogram(
+    'mp3printer_fanout_seconds',
+    'Time from a broadcast being sent until it was handed to every client'
+)
+FANOUT_BYTES = metrics.histogram(
+    'mp3printer_fanout_bytes',
+    'Bytes sent to all clients by a broadcast',
+    metrics.BYTES_BUCKETS
+)
+FANOUT_WIRE_BYTES = metrics.histogram(
+    'mp3printer_fanout_wire_bytes',
+    'Bytes on the wire (after compression and framing) for a broadcast',
+    metrics.BYTES_BUCKETS
+)
+
+def _wire_bytes(handler):
+    # Tornado counts these, but only privately
+    connection = handler.ws_connection
+    return getattr(connection, '_wire_bytes_out', 0) if connection is not None else 0
+
+class _Client:
+    def __init__(self, handler, format):
+        self.handler = handler
+        self.format = format        # One of wire.FORMATS
+        self.buffered = 0           # Bytes handed to the socket but not yet flushed
+        self.pending = {}           # Coalesce key -> encoded message, in send order
+        self.behind_since = None
 
 class Connections:
+    # A client with more than this many bytes in flight stops receiving
+    # messages directly, and gets the latest of each kind once it catches up.
+    HIGH_WATER = 256*1024
+    # Clients that are this far behind, or that have been behind for this
+    # long, are disconnected (they will reconnect and get a fresh list).
+    MAX_PENDING = 64
+    EVICT_AFTER = 30
+    # Message types where a newer message makes any older unsent one useless.
+    # Queue deltas are never coalesced, clients need every one of them.
+    COALESCE = {
+        'anchor': 'anchor',
+        'list': 'queue',
+        'fallback': 'queue',
+    }
+
     def __init__(self, ioloop):
         self.lock = Lock()
         self._ioloop = ioloop
-        self._clients = []
+        self._clients = {}
+        self._sequence = itertools.count()
+        self._stats = {
+            'broadcasts': 0,
+            'bytes': 0,
+            'fanout_last': 0.0,
+            'fanout_max': 0.0,
+            'fanout_total': 0.0,
+            'dropped': 0,
+            'evicted': 0,
+        }
+        self._formats = {}          # Format -> clients using it
+        self._sent = {}             # (format, 'payload' or 'wire') -> bytes sent
 
-    def add_connection(self, handler):
+    def add_connection(self, handler, format='json'):
         self.lock.acquire()
         try:
-            self._clients.append(handler)
+            self._clients[handler] = _Client(handler, format)
+            self._formats[format] = self._formats.get(format, 0) + 1
         finally:
             self.lock.release()
 
     def close_connection(self, handler):
         self.lock.acquire()
         try:
-            self._clients.remove(handler)
+            client = self._clients.pop(handler, None)
+            if client is not None:
+                self._formats[client.format]-= 1
+        finally:
+            self.lock.release()
+
+    # Bytes sent so far, by (format, 'payload' or 'wire')
+    def sent(self):
+        self.lock.acquire()
+        try:
+            return dict(self._sent)
+        finally:
+            self.lock.release()
+
+    def count(self):
+        return len(self._clients)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self.lock.release()
+        stats['clients'] = self.count()
+        stats['fanout_avg'] = stats['fanout_total'] / max(stats['broadcasts'], 1)
+        return stats
+
+    # encoded is the message as JSON, or its wire.Encodings
+    def message_clients(self, message, encoded=None):
+        # Encode once per format in use, then let the IOLoop thread hand it
+        # to every client.
+        start = time.monotonic()
+        encodings = encoded if isinstance(encoded, Encodings) else Encodings(message, encoded)
+        for format, count in list(self._formats.items()):
+            if count > 0:
+                encodings.get(format)
+        key = self.COALESCE.get(message.get('type'))
+        self._ioloop.add_callback(self._fan_out, encodings, key, start)
+
+    def message_client(self, handler, message, encoded=None):
+        # Must be called on the IOLoop thread, e.g. from WSHandler.open
+        client = self._clients.get(handler)
+        if client is not None:
+            encodings = encoded if isinstance(encoded, Encodings) else Encodings(message, encoded)
+            self._send(client, encodings.get(client.format), self.COALESCE.get(message.get('type')))
+
+    def _fan_out(self, encodings, key, start):
+        self.lock.acquire()
+        try:
+            clients = list(self._clients.values())
+        finally:
+            self.lock.release()
+        sent = 0
+        wire = 0
+        for client in clients:
+            data = encodings.get(client.format)
+            wire+= self._send(client, data, key)
+            sent+= len(data)
+        elapsed = time.monotonic() - start
+        FANOUT_SECONDS.observe(elapsed)
+        FANOUT_BYTES.observe(sent)
+        FANOUT_WIRE_BYTES.observe(wire)
+
+        self.lock.acquire()
+        try:
+            self._stats['broadcasts']+= 1
+            self._stats['bytes']+= sent
+            self._stats['fanout_last'] = elapsed
+            self._stats['fanout_max'] = max(self._stats['fanout_max'], elapsed)
+            self._stats['fanout_total']+= elapsed
+        finally:
+            self.lock.release()
+
+    # Returns the bytes that went on the wire right away
+    def _send(self, client, data, key):
+        if client.buffered <= self.HIGH_WATER and not client.pending:
+            return self._write(client, data)
+
+        if key is None:
+            key = next(self._sequence)
+        elif key in client.pending:
+            del(client.pending[key])
+            self._count('dropped')
+        client.pending[key] = data
+
+        now = time.monotonic()
+        if client.behind_since is None:
+            client.behind_since = now
+        if len(client.pending) > self.MAX_PENDING or now - client.behind_since > self.EVICT_AFTER:
+            self._evict(client)
+        return 0
+
+    def _write(self, client, data):
+        before = _wire_bytes(client.handler)
+        try:
+            future = client.handler.write_message(data)
+        except tornado.websocket.WebSocketClosedError:
+            self.close_connection(client.handler)
+            return 0
+        wire = _wire_bytes(client.handler) - before
+        client.buffered+= len(data)
+        future.add_done_callback(lambda f: self._written(client, f, len(data)))
+
+        self.lock.acquire()
+        try:
+            payload_key = (client.format, 'payload')
+            wire_key = (client.format, 'wire')
+            self._sent[payload_key] = self._sent.get(payload_key, 0) + len(data)
+            self._sent[wire_key] = self._sent.get(wire_key, 0) + wire
         finally:
             self.lock.release()
+        return wire
+
+    def _written(self, client, future, size):
+        client.buffered-= size
+        if future.exception() is not None:
+            self.close_connection(client.handler)
+            return
+        while client.pending and client.buffered <= self.HIGH_WATER:
+            key = next(iter(client.pending))
+            self._write(client, client.pending.pop(key))
+        if not client.pending:
+            client.behind_since = None
+
+    def _evict(self, client):
+        print('Evicting client %s, too far behind' % client.handler.request.remote_ip)
+        self.close_connection(client.handler)
+        client.pending.clear()
+        self._count('evicted')
+        client.handler.close(1013, 'Too far behind')
 
-    def message_clients(self, message):
+    def _count(self, stat):
         self.lock.acquire()
         try:
-            for client in self._clients:
-                self._ioloop.add_callback(client.write_message, json.dumps(message))
+            self._stats[stat]+= 1
         finally:
             self.lock.release()
@@ -0,0 +1,261 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import time
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+# local libs
+from connections import Connections
+from wire import Encodings
+
+# With --workers, frontend processes serve HTTP and websockets while a single
+# playback process owns the juggler and the player. They talk over a Unix
+# socket, one JSON object per line:
+#
+#   worker -> playback   {"id": 1, "method": "command", "args": ["room", ...]}
+#   playback -> worker   {"id": 1, "result": ...} or {"id": 1, "error": "..."}
+#   playback -> worker   {"room": "room", "publish": <message for its clients>}
+#
+# Published messages are encoded once in the playback process, and each
+# worker hands that same text to its own clients of that room.
+
+ROOM_PREFIX = b'{"room":'
+PUBLISH_SEPARATOR = b',"publish":'
+
+# A result that is already JSON, sent as is
+class Encoded(str):
+    pass
+
+def _frame(prefix, encoded):
+    return prefix + encoded.encode() + b'}\n'
+
+# Stands in for Connections as the clients of one room's juggler
+class _RoomPublisher:
+    def __init__(self, server, room):
+        self._server = server
+        self._prefix = ROOM_PREFIX + json.dumps(room).encode() + PUBLISH_SEPARATOR
+        self.anchor = None
+
+    def message_clients(self, message, encoded=None):
+        # Called from juggler threads, the streams belong to the IOLoop thread
+        data = _frame(self._prefix, encoded if encoded is not None else json.dumps(message))
+        if message.get('type') == 'anchor':
+            self.anchor = data
+        key = Connections.COALESCE.get(message.get('type'))
+        self._server.publish(data, None if key is None else (self._prefix, key))
+
+class _Worker:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffered = 0           # Bytes handed to the stream but not yet flushed
+        self.pending = {}           # Coalesce key -> frame, in send order
+        self.behind_since = None
+
+# The playback side. Publishes what the rooms' jugglers send their clients,
+# and runs the workers' requests through handlers (method name -> coroutine).
+# A worker that stops reading is held back like a slow client in Connections:
+# past HIGH_WATER its messages wait, newer ones replacing older ones of the
+# same kind, and it is disconnected once too far behind.
+class PlaybackServer(tornado.tcpserver.TCPServer):
+    HIGH_WATER = 4*1024*1024
+    MAX_PENDING = 1024
+    EVICT_AFTER = 30
+
+    def __init__(self, ioloop, path, handlers):
+        super().__init__()
+        self._ioloop = ioloop
+        self._handlers = handlers
+        self._streams = {}          # IOStream -> _Worker
+        self._sequence = itertools.count()
+        self._stats = {'dropped': 0, 'evicted': 0}
+        self._publishers = []
+        self._path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.add_socket(tornado.netutil.bind_unix_socket(path))
+
+    def stop(self):
+        super().stop()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def count(self):
+        return len(self._streams)
+
+    def stats(self):
+        # Only changed on the IOLoop thread
+        return dict(self._stats)
+
+    # What to give the juggler of room as its clients
+    def publisher(self, room):
+        publisher = _RoomPublisher(self, room)
+        self._publishers.append(publisher)
+        return publisher
+
+    def publish(self, data, key=None):
+        self._ioloop.add_callback(self._fan_out, data, key)
+
+    def _fan_out(self, data, key):
+        for worker in list(self._streams.values()):
+            self._send(worker, data, key)
+
+    def _send(self, worker, data, key):
+        if worker.buffered <= self.HIGH_WATER and not worker.pending:
+            self._write(worker, data)
+            return
+
+        if key is None:
+            key = next(self._sequence)
+        elif key in worker.pending:
+            del(worker.pending[key])
+            self._stats['dropped']+= 1
+        worker.pending[key] = data
+
+        now = time.monotonic()
+        if worker.behind_since is None:
+            worker.behind_since = now
+        if len(worker.pending) > self.MAX_PENDING or now - worker.behind_since > self.EVICT_AFTER:
+            print('Disconnecting a worker, too far behind')
+            self._streams.pop(worker.stream, None)
+            worker.pending.clear()
+            self._stats['evicted']+= 1
+            worker.stream.close()
+
+    def _write(self, worker, data):
+        try:
+            future = worker.stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            self._streams.pop(worker.stream, None)
+            return
+        worker.buffered+= len(data)
+        future.add_done_callback(lambda f: self._written(worker, f, len(data)))
+
+    def _written(self, worker, future, size):
+        worker.buffered-= size
+        if future.exception() is not None:
+            self._streams.pop(worker.stream, None)
+            return
+        while worker.pending and worker.buffered <= self.HIGH_WATER:
+            key = next(iter(worker.pending))
+            self._write(worker, worker.pending.pop(key))
+        if not worker.pending:
+            worker.behind_since = None
+
+    async def handle_stream(self, stream, address):
+        self._streams[stream] = _Worker(stream)
+        for publisher in self._publishers:
+            if publisher.anchor is not None:
+                stream.write(publisher.anchor)
+        try:
+            while True:
+                line = await stream.read_until(b'\n')
+                request = json.loads(line)
+                self._ioloop.add_callback(self._respond, stream, request)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self._streams.pop(stream, None)
+
+    async def _respond(self, stream, request):
+        try:
+            result = await self._handlers[request['method']](*request['args'])
+            if isinstance(result, Encoded):
+                data = _frame(b'{"id":%d,"result":' % request['id'], result)
+            else:
+                data = _frame(b'{"id":%d,"result":' % request['id'], json.dumps(result))
+        except Exception as err:
+            data = (json.dumps({'id': request['id'], 'error': str(err)}) + '\n').encode()
+        try:
+            stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+# The worker side: hands published messages to the worker's own Connections
+# of each room (rooms maps room name -> Connections) and sends requests to
+# the playback process.
+class PlaybackClient:
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self, rooms, path):
+        self._rooms = rooms
+        self._path = path
+        self._stream = None
+        self._ids = 0
+        self._calls = {}        # Request id -> asyncio.Future
+        self._version = {}      # Room -> version of its latest queue message
+        self._snapshot = {}     # Room -> (version, Encodings) of the latest fetched
+        self._fetching = {}     # Room -> asyncio.Future of a snapshot on its way
+        self._anchor = {}       # Room -> its latest anchor
+
+    def anchor(self, room):
+        return self._anchor.get(room)
+
+    async def connect(self):
+        # The playback process may still be setting up its socket
+        for i in range(self.CONNECT_TIMEOUT * 10):
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._stream = tornado.iostream.IOStream(sock)
+                await self._stream.connect(self._path)
+                break
+            except (tornado.iostream.StreamClosedError, OSError):
+                await asyncio.sleep(0.1)
+        else:
+            raise Exception('Could not connect to the playback process at '+self._path)
+        asyncio.ensure_future(self._read())
+
+    async def call(self, method, *args):
+        self._ids+= 1
+        future = asyncio.get_running_loop().create_future()
+        self._calls[self._ids] = future
+        self._stream.write((json.dumps({'id': self._ids, 'method': method, 'args': args}) + '\n').encode())
+        return await future
+
+    # The wire.Encodings of the latest list (or fallback) message of room
+    async def snapshot(self, room):
+        cached = self._snapshot.get(room)
+        if cached is not None and cached[0] == self._version.get(room):
+            return cached[1]
+        if room not in self._fetching:
+            self._fetching[room] = asyncio.ensure_future(self.call('snapshot', room))
+        fetching = self._fetching[room]
+        try:
+            message = await fetching
+        finally:
+            if self._fetching.get(room) is fetching:
+                del(self._fetching[room])
+        encodings = Encodings(message)
+        self._snapshot[room] = (message['version'], encodings)
+        return encodings
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self._stream.read_until(b'\n')
+                if line.startswith(ROOM_PREFIX):
+                    room, separator, encoded = line[len(ROOM_PREFIX):-2].partition(PUBLISH_SEPARATOR)
+                    room = json.loads(room)
+                    encoded = encoded.decode()
+                    message = json.loads(encoded)
+                    if message.get('type') == 'anchor':
+                        self._anchor[room] = message
+                    elif 'version' in message:
+                        self._version[room] = message['version']
+                    if room in self._rooms:
+                        self._rooms[room].message_clients(message, encoded)
+                    continue
+                reply = json.loads(line)
+                future = self._calls.pop(reply['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in reply:
+                    future.set_exception(Exception(reply['error']))
+                else:
+                    future.set_result(reply['result'])
+        except tornado.iostream.StreamClosedError:
+            print('Lost the playback process, exiting')
+            os._exit(1)
@@ -0,0 +1,417 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from threading import Lock, Thread
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+# shutil.disk_usage for a directory, looked up at most once a second
+_free_space = {}
+def free_space(path):
+    now = time.monotonic()
+    if path not in _free_space or _free_space[path][0] < now:
+        _free_space[path] = (now + 1, shutil.disk_usage(path).free)
+    return _free_space[path][1]
+
+# A file handle shared by several tracks (identical uploads), which is only
+# closed (and, for a temp file, deleted) when the last of them closes it.
+class SharedHandle:
+    def __init__(self, handle):
+        self._handle = handle
+        self._retired = []      # Replaced handles that may still be in use
+        self._users = 1
+        self.lock = Lock()
+
+    @property
+    def name(self):
+        return self._handle.name
+
+    @property
+    def closed(self):
+        return self._users <= 0
+
+    def share(self):
+        self.lock.acquire()
+        try:
+            if self._users <= 0:
+                return None
+            self._users+= 1
+            return self
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._users-= 1
+            if self._users == 0:
+                self._handle.close()
+                for handle in self._retired:
+                    handle.close()
+        finally:
+            self.lock.release()
+
+    # Puts handle (e.g. of a smaller copy) in place of the file, closing the
+    # old one now, or only with the rest if keep_old. Returns False (and
+    # closes handle) if everyone is already done with the file.
+    def replace(self, handle, keep_old=False):
+        self.lock.acquire()
+        try:
+            if self._users <= 0:
+                handle.close()
+                return False
+            old, self._handle = self._handle, handle
+            if keep_old:
+                self._retired.append(old)
+            else:
+                old.close()
+            return True
+        finally:
+            self.lock.release()
+
+# An upload handed over by a --workers frontend process, which hard links
+# its temp file for us. Stands in for that temp file, deleting it on close.
+class HandedOverFile:
+    def __init__(self, path):
+        self.name = path
+
+    def close(self):
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+# Accounts for the disk space uploads take while they are received and
+# queued: each reserves its size up front, and gives it back once it's no
+# longer on disk (or never made it). budget limits all of them together,
+# per_address how much one address may hold (0: no limit).
+class DiskBudget:
+    def __init__(self, budget=0, per_address=0):
+        self.lock = Lock()
+        self._budget = budget
+        self._per_address = per_address
+        self._reservations = {}     # Reservation id -> [address, bytes]
+        self._by_address = {}
+        self._held = 0
+
+    # Returns the id of a reservation of size bytes for address, or raises
+    def reserve(self, address, size):
+        self.lock.acquire()
+        try:
+            if self._budget > 0 and self._held + size > self._budget:
+                raise Exception('The server is holding too many uploads, please wait for some to play')
+            held = self._by_address.get(address, 0)
+            if self._per_address > 0 and held + size > self._per_address:
+                raise Exception('You already have %.1f MiB of uploads queued, please wait for some to play' % (held / (1024*1024)))
+            reservation = uuid.uuid4().hex
+            self._reservations[reservation] = [address, 0]
+            self._add(reservation, size)
+            return reservation
+        finally:
+            self.lock.release()
+
+    # The upload turned out to take size bytes after all
+    def resize(self, reservation, size):
+        self.lock.acquire()
+        try:
+            if reservation in self._reservations:
+                self._add(reservation, size - self._reservations[reservation][1])
+        finally:
+            self.lock.release()
+
+    # Gives the space back, releasing a reservation twice is harmless
+    def release(self, reservation):
+        self.lock.acquire()
+        try:
+            if reservation in self._reservations:
+                self._add(reservation, -self._reservations[reservation][1])
+                address = self._reservations.pop(reservation)[0]
+                if self._by_address[address] <= 0:
+                    del(self._by_address[address])
+        finally:
+            self.lock.release()
+
+    def _add(self, reservation, delta):
+        # Must be called with the lock held
+        address = self._reservations[reservation][0]
+        self._reservations[reservation][1]+= delta
+        self._by_address[address] = self._by_address.get(address, 0) + delta
+        self._held+= delta
+
+    def usage(self):
+        self.lock.acquire()
+        try:
+            return {'held': self._held, 'budget': self._budget, 'per_address': self._per_address}
+        finally:
+            self.lock.release()
+
+    def by_address(self):
+        self.lock.acquire()
+        try:
+            return dict(self._by_address)
+        finally:
+            self.lock.release()
+
+# One upload being written by the UploadWriter
+class UploadSink:
+    def __init__(self, writer, handle):
+        self._writer = writer
+        self._handle = handle
+        self._hash = hashlib.sha256()
+        self._aborted = False
+        self._submitted = 0     # Only touched on the IOLoop thread
+        self._written = 0       # Only touched on the writer thread
+        self.error = None
+
+    @property
+    def size(self):
+        return self._submitted
+
+    @property
+    def buffered(self):
+        return self._submitted - self._written
+
+    # Returns a concurrent.futures.Future that is done when chunk is on disk
+    def write(self, chunk):
+        self._submitted+= len(chunk)
+        return self._writer.submit(self._write, chunk)
+
+    # Returns a concurrent.futures.Future of the hex digest of everything written
+    def finish(self):
+        return self._writer.submit(self._finish)
+
+    def abort(self):
+        self._aborted = True
+        self._writer.submit(self._handle.close)
+
+    def _write(self, chunk):
+        self._written+= len(chunk)
+        if self._aborted or self.error is not None:
+            return
+        try:
+            self._handle.write(chunk)
+            self._hash.update(chunk)
+        except Exception as err:
+            self.error = err
+
+    def _finish(self):
+        if self.error is not None:
+            raise self.error
+        self._handle.flush()
+        return self._hash.hexdigest()
+
+# Writes uploaded chunks to disk (and hashes them) on a thread of its own, in
+# the order they arrive, so the IOLoop never waits for the disk.
+class UploadWriter:
+    # An upload stops reading from its socket while it has more than this
+    # many bytes waiting to be written.
+    MAX_BUFFERED = 4*1024*1024
+
+    def __init__(self):
+        self._queue = Queue()
+        self._running = True
+        self._thread = Thread(target=self._run, args=())
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._queue.put(None)
+        self._thread.join()
+
+    def open(self, handle):
+        return UploadSink(self, handle)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def _run(self):
+        while self._running:
+            job = self._queue.get()
+            if job is None:
+                break
+            future, fn, args = job
+            try:
+                future.set_result(fn(*args))
+            except Exception as err:
+                future.set_exception(err)
+
+# One chunk of an upload session being written by the UploadWriter, at its
+# offset into the session's file.
+class ChunkSink:
+    def __init__(self, sessions, writer, sid, offset, length):
+        self._sessions = sessions
+        self._writer = writer
+        self._sid = sid
+        self._offset = offset
+        self._length = length
+        self._fd = os.open(sessions.path(sid, '.part'), os.O_WRONLY)
+        self._submitted = 0     # Only touched on the IOLoop thread
+        self._written = 0       # Only touched on the writer thread
+        self.error = None
+
+    @property
+    def buffered(self):
+        return self._submitted - self._written
+
+    def write(self, chunk):
+        position = self._offset + self._submitted
+        self._submitted+= len(chunk)
+        if self._submitted > self._length:
+            self.error = Exception('Chunk is longer than announced')
+        return self._writer.submit(self._write, chunk, position)
+
+    # Future that is done once the whole chunk is on disk and recorded
+    def finish(self):
+        return self._writer.submit(self._finish)
+
+    def abort(self):
+        self._writer.submit(self._close)
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _write(self, chunk, position):
+        self._written+= len(chunk)
+        if self.error is not None:
+            return
+        try:
+            os.pwrite(self._fd, chunk, position)
+        except Exception as err:
+            self.error = err
+
+    def _finish(self):
+        self._close()
+        if self.error is not None:
+            raise self.error
+        if self._written != self._length:
+            raise Exception('Chunk ended early')
+        self._sessions.landed(self._sid, self._offset, self._offset + self._length)
+
+# Chunked, resumable uploads. A session is a file of the final size that
+# chunks (sent in any order, in parallel, again if lost) are written into at
+# their offsets, next to the upload's details (.json) and a log of the byte
+# ranges that have fully landed (.ranges). It's all kept on disk, so with
+# --workers any frontend process can take any chunk, and once every byte has
+# landed the file itself becomes the upload, without being copied.
+class UploadSessions:
+    CHUNK_SIZE = 8*1024*1024    # What clients are told to use
+    EXPIRE_AFTER = 3600         # Seconds without a new chunk
+    SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, writer, directory, hashers=2):
+        self._writer = writer
+        self._directory = directory
+        # Hashing a finished upload reads all of it, which would hold up
+        # every other upload's writes on the writer thread
+        self._hasher = ThreadPoolExecutor(max_workers=hashers, thread_name_prefix='hash')
+        os.makedirs(directory, exist_ok=True)
+
+    def stop(self):
+        self._hasher.shutdown(wait=False, cancel_futures=True)
+
+    def path(self, sid, suffix=''):
+        if not self.SESSION_ID.match(sid):
+            raise KeyError(sid)
+        return os.path.join(self._directory, sid + suffix)
+
+    # Starts a session for size bytes, details are kept for the upload
+    def create(self, details, size):
+        sid = uuid.uuid4().hex
+        with open(self.path(sid, '.part'), 'wb') as f:
+            f.truncate(size)
+        with open(self.path(sid, '.ranges'), 'wb'):
+            pass
+        with open(self.path(sid, '.json'), 'w') as f:
+            json.dump(dict(details, size=size), f)
+        return sid
+
+    def details(self, sid):
+        try:
+            with open(self.path(sid, '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(sid)
+
+    def open_chunk(self, sid, offset, length):
+        size = self.details(sid)['size']
+        if offset < 0 or length < 0 or offset + length > size:
+            raise Exception('Chunk is outside the upload')
+        return ChunkSink(self, self._writer, sid, offset, length)
+
+    def landed(self, sid, start, end):
+        # Appends this short are atomic, even from several processes
+        fd = os.open(self.path(sid, '.ranges'), os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, b'%d %d\n' % (start, end))
+        finally:
+            os.close(fd)
+
+    # The byte ranges that have landed, merged, as [[start, end], ...]
+    def received(self, sid):
+        try:
+            with open(self.path(sid, '.ranges')) as f:
+                ranges = sorted(tuple(int(n) for n in line.split()) for line in f if line.strip())
+        except FileNotFoundError:
+            raise KeyError(sid)
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    # Future of (path, hex digest) of the finished upload, which the caller
+    # then owns. Every chunk has landed by then, so the file is read once for
+    # the hash on a thread of its own, not the writer's.
+    def finish(self, sid, suffix=''):
+        return self._hasher.submit(self._finish, sid, suffix)
+
+    def _finish(self, sid, suffix):
+        size = self.details(sid)['size']
+        if self.received(sid) != ([[0, size]] if size > 0 else []):
+            raise Exception('Upload is not complete')
+        digest = hashlib.sha256()
+        with open(self.path(sid, '.part'), 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                digest.update(block)
+        path = self.path(sid, suffix)
+        os.rename(self.path(sid, '.part'), path)
+        self._remove(sid, ('.json', '.ranges'))
+        return path, digest.hexdigest()
+
+    def abort(self, sid):
+        self._remove(sid, ('.json', '.ranges', '.part'))
+
+    def _remove(self, sid, suffixes):
+        for suffix in suffixes:
+            try:
+                os.unlink(self.path(sid, suffix))
+            except FileNotFoundError:
+                pass
+
+    # Removes sessions that haven't had a chunk land for a while, returns
+    # their details
+    def expire(self):
+        deadline = time.time() - self.EXPIRE_AFTER
+        expired = []
+        for name in os.listdir(self._directory):
+            sid, extn = os.path.splitext(name)
+            if extn != '.json':
+                continue
+            try:
+                if os.stat(self.path(sid, '.ranges')).st_mtime < deadline:
+                    print('Upload session %s expired' % sid)
+                    expired.append(self.details(sid))
+                    self.abort(sid)
+            except (FileNotFoundError, KeyError):
+                pass
+        return expired
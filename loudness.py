@@ -0,0 +1,170 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+import json
+import os
+import re
+import shutil
+import subprocess
+
+# local libs
+from resolver import canonical_url
+
+INTEGRATED = re.compile(r'I:\s+(-?\d+(?:\.\d+)?) LUFS')
+
+# Measures the loudness of queued tracks (EBU R128 integrated loudness, with
+# ffmpeg's ebur128 filter) in the background, and works out the gain in dB
+# that brings each to the target loudness. Results are cached by content hash
+# for uploads and by canonical URL for links, optionally in cache_file so they
+# last across restarts, so the same song is only ever measured once. Links
+# that aren't prefetched are streamed, so only their first link_seconds are
+# measured, rather than pulling most of a long video off the network.
+class LoudnessAnalyzer:
+    # Boosting more than this would clip, cutting more is never needed
+    MIN_GAIN = -20.0
+    MAX_GAIN = 6.0
+    # Measurements below this are silence (or nothing), and get no gain
+    SILENCE = -70.0
+    CACHE_SIZE = 10000
+
+    def __init__(self, resolver, prefetcher=None, ffmpeg='ffmpeg', target=-18.0, workers=1, cache_file=None, max_seconds=600, link_seconds=60):
+        self.lock = Lock()
+        self._resolver = resolver
+        self._prefetcher = prefetcher
+        self._ffmpeg = shutil.which(ffmpeg)
+        if self._ffmpeg is None:
+            raise Exception('Could not find ffmpeg ("%s")' % ffmpeg)
+        self._target = target
+        self._cache_file = cache_file
+        self._max_seconds = max_seconds
+        self._link_seconds = link_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='loudness')
+        self._cache = OrderedDict()     # Key -> gain in dB, in LRU order
+        self._in_flight = {}            # Key -> Future
+        self._save_lock = Lock()        # Taken without self.lock, to write cache_file
+        self._stats = {'hits': 0, 'misses': 0, 'shared': 0, 'errors': 0}
+        self._load_cache()
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['cached'] = len(self._cache)
+        finally:
+            self.lock.release()
+        return stats
+
+    def _key(self, track):
+        if 'hash' in track:
+            return 'hash:' + track['hash']
+        if track['type'] == 'link':
+            return 'url:' + canonical_url(track['mrl'])
+        return None
+
+    # Future of the gain in dB for track, None if it can't be measured. Never
+    # waits for the measurement, cached gains come back done.
+    def analyze(self, track):
+        key = self._key(track)
+        future = Future()
+        if key is None:
+            future.set_result(None)
+            return future
+        self.lock.acquire()
+        try:
+            if key in self._cache:
+                self._stats['hits']+= 1
+                self._cache.move_to_end(key)
+                future.set_result(self._cache[key])
+                return future
+            if key in self._in_flight:
+                self._stats['shared']+= 1
+                return self._in_flight[key]
+            self._stats['misses']+= 1
+            future = self._executor.submit(self._analyze, key, track['type'], track['mrl'], track['filename'])
+            self._in_flight[key] = future
+            return future
+        finally:
+            self.lock.release()
+
+    # Returns what ffmpeg should read, and for how many seconds at most
+    def _source(self, track_type, mrl):
+        if track_type != 'link':
+            return mrl, self._max_seconds
+        if self._prefetcher is not None:
+            path = self._prefetcher.lookup(mrl)
+            if path is not None:
+                return path, self._max_seconds
+        return self._resolver.resolve(mrl).result()['url'], self._link_seconds
+
+    def _analyze(self, key, track_type, mrl, filename):
+        gain = None
+        try:
+            source, seconds = self._source(track_type, mrl)
+            result = subprocess.run(
+                [self._ffmpeg, '-nostdin', '-hide_banner', '-nostats', '-t', str(seconds),
+                    '-i', source, '-vn', '-sn', '-dn',
+                    '-af', 'ebur128=framelog=quiet', '-f', 'null', '-'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True
+            )
+            # The last one is the summary for the whole track
+            measured = INTEGRATED.findall(result.stderr.decode(errors='replace'))
+            if not measured:
+                raise Exception('No loudness in ffmpeg output')
+            loudness = float(measured[-1])
+            gain = 0.0
+            if loudness > self.SILENCE:
+                gain = min(max(self._target - loudness, self.MIN_GAIN), self.MAX_GAIN)
+        except Exception as err:
+            if isinstance(err, subprocess.CalledProcessError):
+                err = err.stderr.decode(errors='replace').strip().splitlines()[-1:] or err
+            print('Could not measure loudness of %s: %s' % (filename, err))
+
+        self.lock.acquire()
+        try:
+            del(self._in_flight[key])
+            if gain is None:
+                self._stats['errors']+= 1
+            else:
+                self._cache[key] = gain
+                while len(self._cache) > self.CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        finally:
+            self.lock.release()
+        if gain is not None:
+            self._save_cache()
+        return gain
+
+    def _load_cache(self):
+        if self._cache_file is None:
+            return
+        try:
+            with open(self._cache_file) as f:
+                self._cache.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def _save_cache(self):
+        # Called without the lock, analyze() (under the juggler's lock) must
+        # never wait for the file. Only the copy is made under the lock.
+        if self._cache_file is None:
+            return
+        self._save_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                items = list(self._cache.items())
+            finally:
+                self.lock.release()
+            with open(self._cache_file + '.tmp', 'w') as f:
+                json.dump(items, f)
+            os.replace(self._cache_file + '.tmp', self._cache_file)
+        except OSError as err:
+            print(err)
+        finally:
+            self._save_lock.release()
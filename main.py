@@ -1,35 +1,52 @@
+import metrics     # First, so startup phases are timed from here
+import asyncio
+import importlib.util
 import os
 import re
 import signal
-import shutil
 import tempfile
 import threading
+import time
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
 import tornado.web
 import socket
 import json
-import yt_dlp
 import argparse
+import functools
 import urllib.parse
 
 
-# optional lib
-try:
-    import pychromecast.discovery
-    HAS_PYCHROMECAST = True
-except ModuleNotFoundError:
-    HAS_PYCHROMECAST = False
+# optional lib, only imported when actually used
+HAS_PYCHROMECAST = importlib.util.find_spec('pychromecast') is not None
 
 # local libs
+import wire
 from connections import Connections
+from fanout import Encoded, PlaybackClient, PlaybackServer
+from ingest import DiskBudget, HandedOverFile, UploadSessions, UploadWriter, free_space
+from loudness import LoudnessAnalyzer
 from mp3Juggler import mp3Juggler
+from prefetch import Prefetcher
+from resolver import Resolver
+from simulation import SimulatedBackend, StubResolver
+from transcode import AudioExtractor
 
 loop = None
-clients = None
-juggler = None
+rooms = {}          # Room name -> Room, the default room is ''
+resolver = None
+prefetcher = None
+extractor = None
+analyzer = None
+writer = None
+sessions = None     # Chunked upload sessions, kept on disk next to the temp files
+budget = None       # Disk space held by uploads, where the jugglers are
 http_server = None
+playback = None     # With --workers, the frontends' connection to the jugglers
+playback_server = None  # With --workers, the playback process's side of that
+workers = []        # With --workers, the frontend process ids
+ws_compression = None   # permessage-deflate options, None to not compress
 
 ANSI_ESCAPE = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -/]*[@-~]')
 ERROR_PREFIX = re.compile(r'^[Ee][Rr][Rr]([Oo][Rr])?:\s*')
@@ -43,26 +60,100 @@ def forwarded_remote_ip(request):
     return request.headers.get('X-Forwarded-For')
 remote_ip = actual_remote_ip
 
+ROOM_NAME = re.compile(r'^[\w-]+$')
+ROOM_PATH = re.compile(r'^/r/([\w-]+)/')
+
+# A queue of its own, with its own player, clients and lock. Named rooms are
+# served under /r/<name>/, the default room ('') at the top level. Without a
+# juggler, it is a --workers frontend's view of a room in the playback process.
+class Room:
+    def __init__(self, name, clients, juggler=None):
+        self.name = name
+        self.clients = clients
+        self.juggler = juggler
+
+def find_room(request):
+    match = ROOM_PATH.match(request.path)
+    room = rooms.get(match.group(1) if match else '')
+    if room is None:
+        raise tornado.web.HTTPError(404)
+    return room
+
+MAX_UPLOAD = 1024*1024*1024 # 1GiB
+SESSION_DIR = os.path.join(tempfile.gettempdir(), 'mp3printer-uploads')
+
+UPLOAD_RATE = metrics.histogram(
+    'mp3printer_upload_bytes_per_second',
+    'Throughput of finished uploads',
+    metrics.RATE_BUCKETS
+)
+
 class IndexHandler(tornado.web.RequestHandler):
+    @tornado.web.addslash
     def get(self):
+        find_room(self.request)
+        metrics.phase('first request')
         self.render("index.html")
 
+class MetricsHandler(tornado.web.RequestHandler):
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        if playback is not None:
+            # The queue and player live there, this frontend's own metrics
+            # (fan-out, uploads) are left out.
+            self.finish(await playback.call('metrics'))
+        else:
+            self.finish(metrics.render())
+
+# Whether an upload of size bytes may start, returns its filename and extension
+def check_upload(room, request, size):
+    free = free_space(tempfile.gettempdir())
+    if size > free/2:
+        raise Exception('Uploaded file too large for current free space')
+    if size > MAX_UPLOAD:
+        raise Exception('Uploaded file too large')
+    if room.juggler is not None:
+        room.juggler.check_quota(remote_ip(request))
+    file_type = request.headers.get('Content-Type')
+    if not file_type.startswith('audio/') and not file_type.startswith('video/'):
+        raise Exception('Only audio or video files, please')
+    filename = request.headers.get('Filename')
+    return filename, os.path.splitext(filename)[-1]
+
+# Reserves disk space for an upload of size bytes, in whichever process keeps
+# the budget, returns the reservation
+async def reserve_upload(request, size):
+    if playback is not None:
+        return await playback.call('reserve', remote_ip(request), size)
+    return budget.reserve(remote_ip(request), size)
+
+def release_upload(reservation):
+    if reservation is None:
+        return
+    if playback is not None:
+        asyncio.ensure_future(playback.call('release', reservation))
+    else:
+        budget.release(reservation)
+
 @tornado.web.stream_request_body
 class Upload(tornado.web.RequestHandler):
-    def prepare(self):
-        self.fh = None
+    async def prepare(self):
+        self.room = find_room(self.request)
+        self.started = time.monotonic()
+        self.sink = None
         self.infile = None
+        self.reservation = None
         self.error = None
         self.done = False
         try:
-            free = shutil.disk_usage(tempfile.gettempdir()).free
-            if int(self.request.headers.get('Content-Length')) > free/2:
-                raise Exception('Uploaded file too large for current free space')
-            file_type = self.request.headers.get('Content-Type')
-            if not file_type.startswith('audio/') and not file_type.startswith('video/'):
-                raise Exception('Only audio or video files, please')
-            filename = self.request.headers.get('Filename')
-            extn = os.path.splitext(filename)[-1]
+            size = int(self.request.headers.get('Content-Length'))
+            filename, extn = check_upload(self.room, self.request, size)
+            reservation = await reserve_upload(self.request, size)
+            if self.done:
+                # The client went away meanwhile
+                release_upload(reservation)
+                return
+            self.reservation = reservation
             tf = tempfile.NamedTemporaryFile(prefix=filename, suffix=extn)
             self.infile = {
                 'type': 'file',
@@ -70,27 +161,33 @@ class Upload(tornado.web.RequestHandler):
                 'nick': self.request.headers.get('Nick'),
                 'filename': filename,
                 'extn': extn,
+                'video': self.request.headers.get('Content-Type').startswith('video/'),
                 'address': remote_ip(self.request),
                 'mrl': tf.name,
-                'handle': tf
+                'handle': tf,
+                'reservation': self.reservation
             }
-            self.fh = tf
+            self.sink = writer.open(tf)
         except Exception as err:
             self.error = err
 
-    def data_received(self, chunk):
+    async def data_received(self, chunk):
         if self.error is None:
-            try:
-                self.fh.write(chunk)
-            except Exception as err:
-                self.error = err
+            written = self.sink.write(chunk)
+            # Stop reading from the client until the disk catches up
+            if self.sink.buffered > writer.MAX_BUFFERED:
+                await asyncio.wrap_future(written)
 
-    def put(self):
+    async def put(self):
         try:
             if self.error is not None:
                 raise self.error
-            self.fh.flush()
-            juggler.juggle(self.infile, self.request.headers.get('Parent-Id'))
+            self.infile['hash'] = await asyncio.wrap_future(self.sink.finish())
+            UPLOAD_RATE.observe(self.sink.size / max(time.monotonic() - self.started, 0.001))
+            if playback is not None:
+                await self.hand_over(self.request.headers.get('Parent-Id'))
+            else:
+                self.room.juggler.juggle(self.infile, self.request.headers.get('Parent-Id'))
             self.done = True
             self.finish()
         except Exception as err:
@@ -99,113 +196,459 @@ class Upload(tornado.web.RequestHandler):
             self.set_status(500)
             self.finish(error_message(err))
 
+    # Gives the upload to the playback process, under a name of its own
+    async def hand_over(self, parent_id):
+        handle = self.infile['handle']
+        infile = dict(self.infile, mrl=handle.name + '.queued')
+        del(infile['handle'])
+        os.link(handle.name, infile['mrl'])
+        try:
+            await playback.call('upload', self.room.name, infile, parent_id)
+        except Exception:
+            HandedOverFile(infile['mrl']).close()
+            raise
+        finally:
+            handle.close()
+
     def on_finish(self):
         if not self.done:
-            try:
-                self.fh.close()
-            except:
-                pass
+            if self.sink is not None:
+                self.sink.abort()
+            release_upload(self.reservation)
             self.done = True
 
     def on_connection_close(self):
         self.on_finish()
         super().on_connection_close()
 
-class Download(tornado.web.RequestHandler):
-    def get(self, track_id):
+# Chunked, resumable uploads, see ingest.UploadSessions:
+#
+#   POST   upload/session              Same headers as a PUT to upload, but
+#                                      with Upload-Length instead of a body.
+#                                      Replies {"session": id, "chunk_size": n}
+#   PUT    upload/session/ID           A chunk, starting at Upload-Offset
+#   GET    upload/session/ID           {"size": n, "received": [[start, end], ...]}
+#   POST   upload/session/ID/finish    Queues the upload, once all of it landed
+#   DELETE upload/session/ID           Gives up on the upload
+class UploadSessionStart(tornado.web.RequestHandler):
+    def prepare(self):
+        self.room = find_room(self.request)
+
+    async def post(self):
+        reservation = None
         try:
-            infile = juggler.download(track_id)
+            size = int(self.request.headers.get('Upload-Length'))
+            filename, extn = check_upload(self.room, self.request, size)
+            reservation = await reserve_upload(self.request, size)
+            sid = sessions.create({
+                'room': self.room.name,
+                'upload_id': self.request.headers.get('Upload-Id'),
+                'parent_id': self.request.headers.get('Parent-Id'),
+                'nick': self.request.headers.get('Nick'),
+                'filename': filename,
+                'extn': extn,
+                'video': self.request.headers.get('Content-Type').startswith('video/'),
+                'address': remote_ip(self.request),
+                'started': time.time(),
+                'reservation': reservation
+            }, size)
+            self.finish({'session': sid, 'chunk_size': sessions.CHUNK_SIZE})
+        except Exception as err:
+            release_upload(reservation)
+            print(err)
+            self.set_status(500)
+            self.finish(error_message(err))
+
+# The details of the session in the handler's path, which must be of its room
+def session_details(handler, sid):
+    try:
+        details = sessions.details(sid)
+    except KeyError:
+        raise tornado.web.HTTPError(404)
+    if details['room'] != handler.room.name:
+        raise tornado.web.HTTPError(404)
+    return details
+
+@tornado.web.stream_request_body
+class UploadChunk(tornado.web.RequestHandler):
+    def prepare(self):
+        self.room = find_room(self.request)
+        self.sink = None
+        self.error = None
+        self.done = False
+        session_details(self, self.path_args[0])
+        if self.request.method != 'PUT':
+            return
+        try:
+            self.sink = sessions.open_chunk(
+                self.path_args[0],
+                int(self.request.headers.get('Upload-Offset')),
+                int(self.request.headers.get('Content-Length'))
+            )
+        except Exception as err:
+            self.error = err
+
+    async def data_received(self, chunk):
+        if self.error is None and self.sink is not None:
+            written = self.sink.write(chunk)
+            if self.sink.buffered > writer.MAX_BUFFERED:
+                await asyncio.wrap_future(written)
+
+    async def put(self, sid):
+        try:
+            if self.error is not None:
+                raise self.error
+            self.done = True
+            await asyncio.wrap_future(self.sink.finish())
+            self.finish()
+        except Exception as err:
+            print(err)
+            self.set_status(500)
+            self.finish(error_message(err))
+
+    def get(self, sid):
+        details = session_details(self, sid)
+        self.finish({'size': details['size'], 'received': sessions.received(sid)})
+
+    def delete(self, sid):
+        details = session_details(self, sid)
+        sessions.abort(sid)
+        release_upload(details['reservation'])
+        self.finish()
+
+    def on_finish(self):
+        if not self.done:
+            if self.sink is not None:
+                self.sink.abort()
+            self.done = True
+
+    def on_connection_close(self):
+        self.on_finish()
+        super().on_connection_close()
+
+class UploadFinish(tornado.web.RequestHandler):
+    def prepare(self):
+        self.room = find_room(self.request)
+
+    async def post(self, sid):
+        details = session_details(self, sid)
+        try:
+            path, digest = await asyncio.wrap_future(sessions.finish(sid, details['extn']))
+        except Exception as err:
+            print(err)
+            self.set_status(500)
+            self.finish(error_message(err))
+            return
+        UPLOAD_RATE.observe(details['size'] / max(time.time() - details['started'], 0.001))
+        infile = {
+            'type': 'file',
+            'upload_id': details['upload_id'],
+            'nick': details['nick'],
+            'filename': details['filename'],
+            'extn': details['extn'],
+            'video': details['video'],
+            'address': details['address'],
+            'mrl': path,
+            'hash': digest,
+            'reservation': details['reservation']
+        }
+        try:
+            if playback is not None:
+                try:
+                    await playback.call('upload', self.room.name, infile, details['parent_id'])
+                except Exception:
+                    HandedOverFile(path).close()
+                    raise
+            else:
+                await queue_upload(self.room.name, infile, details['parent_id'])
+            self.finish()
+        except Exception as err:
+            print(err)
+            self.set_status(500)
+            self.finish(error_message(err))
+
+# Serves queued files through StaticFileHandler, which streams them in chunks
+# (flushing in between) and handles HEAD, Range and conditional requests.
+class Download(tornado.web.StaticFileHandler):
+    def initialize(self):
+        super().initialize(path='/')
+
+    def prepare(self):
+        self.room = find_room(self.request)
+
+    async def get(self, track_id, include_body=True):
+        try:
+            if playback is not None:
+                infile = await playback.call('download', self.room.name, track_id)
+            else:
+                infile = self.room.juggler.download(track_id)
             if infile is None:
                 self.set_status(404)
                 self.finish("Not found")
                 return
-            if infile['type'] == 'file':
-                url_name = urllib.parse.quote(infile['filename'])
-                self.add_header('Content-Disposition',
-                    'attachment; filename="'+url_name+'"')
-                with open(infile['mrl'], 'rb') as f:
-                    chunk = f.read(1048576)
-                    while chunk:
-                        self.write(chunk)
-                        chunk = f.read(1048576)
-                self.finish()
-            elif infile['type'] == 'link':
+            if infile['type'] == 'link':
                 self.redirect(infile['mrl'])
-            else:
+                return
+            elif infile['type'] != 'file':
                 raise Exception('Unknown type: '+infile['type'])
         except Exception as err:
             print(err)
             self.clear()
             self.set_status(500)
             self.finish(error_message(err))
+            return
+
+        url_name = urllib.parse.quote(infile['filename'])
+        self.add_header('Content-Disposition',
+            'attachment; filename="'+url_name+'"')
+        await super().get(infile['mrl'], include_body)
+
+    def compute_etag(self):
+        # The default hashes the whole file, size and mtime will do for these
+        stat = os.stat(self.absolute_path)
+        return '"%x-%x"' % (stat.st_size, stat.st_mtime_ns)
+
+def check_link(link):
+    if not link.startswith('http://') and not link.startswith('https://'):
+        raise Exception('Only web links, please')
+
+# The (link, title) of every track of a (possibly) playlist link
+async def expand_link(link):
+    entries = []
+    await asyncio.wrap_future(resolver.expand(link, lambda url, title: entries.append((url, title))))
+    if not entries:
+        raise Exception('Nothing to play at '+link)
+    return entries
+
+# Queues the tracks of a (possibly) playlist link as they are found, each
+# following the one before it. The last one gets the id the client sent, so
+# whatever the client sends next (with it as parent) follows the whole list.
+# Once the client's quota is full the list is cut short, the last track that
+# fit taking the client's id.
+class PlaylistChain:
+    def __init__(self, juggler, upload_id, nick, address, parent):
+        self._juggler = juggler
+        self._upload_id = upload_id
+        self._nick = nick
+        self._address = address
+        self._parent = parent
+        self._held = None       # Queued once the next entry (or the end) shows up
+        self._count = 0
+        self.error = None       # Why the list was cut short
+        self.stopped = False
+
+    # Called by the resolver as entries are found, which may be on one of its
+    # threads. Hands them to the IOLoop, returns False once no more are wanted.
+    def found(self, link, title):
+        if self.stopped:
+            return False
+        loop.add_callback(self.add, link, title)
+        return True
+
+    def add(self, link, title):
+        if self.stopped:
+            return
+        if self._held is not None:
+            try:
+                # Room for the held one and this one after it
+                self._juggler.check_quota(self._address, 2)
+            except Exception as err:
+                self._stop(err)
+                return
+        self._queue(self._upload_id + '#%d' % (self._count - 1))
+        self._held = (link, title)
+        self._count+= 1
+
+    def finish(self):
+        self._queue(self._upload_id)
+        if self.error is not None:
+            raise self.error
+
+    def _stop(self, err):
+        self.error = err
+        self.stopped = True
+        self._queue(self._upload_id)
+
+    def _queue(self, upload_id):
+        if self._held is None:
+            return
+        link, title = self._held
+        self._held = None
+        try:
+            self._juggler.juggle({
+                'type': 'link',
+                'upload_id': upload_id,
+                'nick': self._nick,
+                'filename': title,
+                'address': self._address,
+                'mrl': link
+            }, self._parent)
+        except Exception as err:
+            self.error = self.error or err
+            self.stopped = True
+            return
+        self._parent = upload_id
+
+# Link, batch and skip commands from a client at address. Run where the
+# juggler is, so with --workers they are sent to the playback process.
+async def run_command(room, parsed_json, address):
+    juggler = room.juggler
+    if parsed_json['type'] == "link":
+        link = parsed_json['link']
+        check_link(link)
+        parent = parsed_json['parent'] if 'parent' in parsed_json else None
+        playlist = PlaylistChain(juggler, parsed_json['id'], parsed_json['nick'], address, parent)
+        juggler.check_quota(address)
+        try:
+            # Entries found before it's done are handed to the IOLoop first
+            await asyncio.wrap_future(resolver.expand(link, playlist.found))
+        finally:
+            playlist.finish()
+    elif parsed_json['type'] == "batch":
+        await queue_batch(juggler, parsed_json, address)
+    elif parsed_json['type'] == "skip":
+        infile = {
+            'address': address,
+            'id': parsed_json['id']
+        }
+        juggler.cancel(infile)
+    else:
+        raise Exception('Unknown command: '+parsed_json['type'])
+
+# A batch is an ordered list of links, and ids of file uploads sent (with
+# Parent-Id) alongside it. Links are all looked up at once, then each run
+# of them between uploads is queued in one go.
+async def queue_batch(juggler, parsed_json, address):
+    items = parsed_json['items']
+    # Uploads are counted when they are queued
+    juggler.check_quota(address, sum(1 for item in items if item['type'] == 'link'))
+    for item in items:
+        if item['type'] == 'link':
+            check_link(item['link'])
+        elif item['type'] != 'upload':
+            raise Exception('Unknown batch item: '+item['type'])
+    found = await asyncio.gather(*[
+        expand_link(item['link']) for item in items if item['type'] == 'link'
+    ])
+
+    parent = parsed_json['parent'] if 'parent' in parsed_json else None
+    run = []
+    for item in items:
+        if item['type'] == 'upload':
+            juggler.juggle_batch(run, parent)
+            run = []
+            parent = item['id']
+            continue
+        entries = found.pop(0)
+        for i, (link, title) in enumerate(entries):
+            run.append({
+                'type': 'link',
+                'upload_id': item['id'] if i == len(entries) - 1 else item['id'] + '#%d' % i,
+                'nick': parsed_json['nick'],
+                'filename': title,
+                'address': address,
+                'mrl': link
+            })
+    juggler.juggle_batch(run, parent)
 
 class WSHandler(tornado.websocket.WebSocketHandler):
 
-    def open(self):
-        clients.add_connection(self)
-        self.write_message(json.dumps({
+    def prepare(self):
+        self.room = find_room(self.request)
+
+    async def open(self):
+        metrics.phase('first websocket connection')
+        format = self.get_argument('format', 'json')
+        self.room.clients.add_connection(self, format if format in wire.FORMATS else 'json')
+        self.room.clients.message_client(self, {
             'type': 'address',
             'address': remote_ip(self.request)
-        }))
-        self.write_message(json.dumps(juggler.get_list()))
+        })
+        await self.send_snapshot()
+        if playback is not None:
+            anchor = playback.anchor(self.room.name)
+        else:
+            anchor = self.room.juggler.get_anchor()
+        if anchor is not None:
+            self.room.clients.message_client(self, anchor)
+
+    async def send_snapshot(self):
+        if playback is not None:
+            encodings = await playback.snapshot(self.room.name)
+        else:
+            encodings = self.room.juggler.get_snapshot().encodings
+        self.room.clients.message_client(self, encodings.message, encodings)
+
+    def get_compression_options(self):
+        return ws_compression
 
-    def on_message(self, message):
+    async def on_message(self, message):
         try:
             parsed_json = json.loads(message)
-            if parsed_json['type'] == "link":
-                link = parsed_json['link']
-                if not link.startswith('http://') and not link.startswith('https://'):
-                    raise Exception('Only web links, please')
-                ydl_opts = {
-                    'quiet': True,
-                    'format': 'bestaudio/best'
-                }
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info_dict = ydl.extract_info(link, download=False)
-                    title = info_dict.get('title', None)
-                infile = {
-                    'type': 'link',
-                    'upload_id': parsed_json['id'],
-                    'nick': parsed_json['nick'],
-                    'filename': title,
-                    'address': remote_ip(self.request),
-                    'mrl': link
-                }
-                parent = parsed_json['parent'] if 'parent' in parsed_json else None
-                juggler.juggle(infile, parent)
-            elif parsed_json['type'] == "skip":
-                infile = {
-                    'address': remote_ip(self.request),
-                    'id': parsed_json['id']
-                }
-                juggler.cancel(infile)
+            if parsed_json['type'] == "resync":
+                await self.send_snapshot()
+            elif playback is not None:
+                await playback.call('command', self.room.name, parsed_json, remote_ip(self.request))
             else:
-                raise Exception('Unknown command: '+parsed_json['type'])
+                await run_command(self.room, parsed_json, remote_ip(self.request))
         except Exception as err:
             print(err)
-            self.write_message(json.dumps({
+            self.room.clients.message_client(self, {
                 'type': 'error',
                 'message': error_message(err)
-            }))
-
+            })
 
     def on_close(self):
         print('connection closed')
-        clients.close_connection(self)
+        self.room.clients.close_connection(self)
 
-def start(port=80, bind=None, player_args=None):
-    global loop, clients, juggler, http_server
-    loop = tornado.ioloop.IOLoop.current()
+# The playback process's side of the --workers requests
+async def remote_command(name, parsed_json, address):
+    await run_command(rooms[name], parsed_json, address)
+
+async def queue_upload(name, infile, parent_id):
+    infile['handle'] = HandedOverFile(infile['mrl'])
+    try:
+        rooms[name].juggler.juggle(infile, parent_id)
+    except Exception:
+        infile['handle'].close()
+        budget.release(infile.get('reservation'))
+        raise
+
+async def reserve_disk(address, size):
+    return budget.reserve(address, size)
+
+async def release_disk(reservation):
+    budget.release(reservation)
 
-    clients = Connections(loop)
-    juggler = mp3Juggler(clients, player_args)
+async def download_info(name, track_id):
+    return rooms[name].juggler.download(track_id)
 
+async def snapshot_json(name):
+    return Encoded(rooms[name].juggler.get_snapshot().json)
+
+async def metrics_text():
+    return metrics.render()
+
+def serve(port, bind, reuse_port=False):
+    global http_server
     application = tornado.web.Application(
         [
             (r'/ws', WSHandler),
             (r'/', IndexHandler),
             (r"/upload", Upload),
+            (r"/upload/session", UploadSessionStart),
+            (r"/upload/session/(\w+)", UploadChunk),
+            (r"/upload/session/(\w+)/finish", UploadFinish),
             (r"/download/(.*)", Download),
+            (r'/r/[\w-]+/ws', WSHandler),
+            (r'/r/[\w-]+/?', IndexHandler),
+            (r'/r/[\w-]+/upload', Upload),
+            (r'/r/[\w-]+/upload/session', UploadSessionStart),
+            (r'/r/[\w-]+/upload/session/(\w+)', UploadChunk),
+            (r'/r/[\w-]+/upload/session/(\w+)/finish', UploadFinish),
+            (r'/r/[\w-]+/download/(.*)', Download),
+            (r"/metrics", MetricsHandler),
         ],
         #compiled_template_cache=False,  # Useful when editing index.html
         static_path=os.path.join(os.path.dirname(__file__), "static")
@@ -213,22 +656,195 @@ def start(port=80, bind=None, player_args=None):
 
     http_server = tornado.httpserver.HTTPServer(
         application,
-        max_body_size=1024*1024*1024, # 1GiB
+        max_body_size=MAX_UPLOAD,
     )
-    http_server.listen(port=port, address=bind)
+    http_server.listen(port=port, address=bind, reuse_port=reuse_port)
+    metrics.phase('listening')
+
+def expire_sessions():
+    for details in sessions.expire():
+        budget.release(details['reservation'])
+
+def per_room(read):
+    return lambda: {name: read(room) for name, room in list(rooms.items())}
+
+# Gauges of the rooms' websocket clients, in whichever process has them
+def client_gauges():
+    metrics.gauge('mp3printer_clients', 'Connected websocket clients',
+        per_room(lambda room: room.clients.count()), 'room')
+    metrics.gauge('mp3printer_sent_bytes', 'Bytes sent to websocket clients, before (payload) and after (wire) compression',
+        lambda: {
+            (name, format, stage): sent
+            for name, room in list(rooms.items())
+            for (format, stage), sent in room.clients.sent().items()
+        },
+        ('room', 'format', 'stage'))
+    metrics.gauge('mp3printer_broadcasts', 'Broadcasts to websocket clients: count, bytes, fan-out times, and messages dropped for and clients evicted for being too far behind',
+        lambda: {
+            (name, stat): value
+            for name, room in list(rooms.items())
+            for stat, value in room.clients.stats().items()
+        },
+        ('room', 'stat'))
+
+# room_args maps the name of each room to its own player arguments (on top of
+# player_args), by default there's just the default room. With socket_path,
+# this is the playback process for --workers frontends (see start_worker) and
+# leaves serving HTTP to them.
+def start(port=80, bind=None, player_args=None, resolver_args=None, prefetch_args=None, simulate=None, max_queued=0, socket_path=None, room_args=None, extract_args=None, loudness_args=None, budget_args=None):
+    global loop, resolver, prefetcher, extractor, analyzer, writer, sessions, budget, playback_server
+    loop = tornado.ioloop.IOLoop.current()
+
+    writer = UploadWriter()
+    sessions = UploadSessions(writer, SESSION_DIR)
+    budget_args = dict(budget_args or {})
+    if budget_args.get('budget') is None:
+        budget_args['budget'] = free_space(tempfile.gettempdir()) // 2
+    budget = DiskBudget(**budget_args)
+    metrics.gauge('mp3printer_upload_disk_bytes', 'Disk space held by uploads, and the limits on it',
+        budget.usage, 'stat')
+    metrics.gauge('mp3printer_upload_disk_bytes_by_address', 'Disk space held by uploads per address',
+        budget.by_address, 'address')
+    # The frontends share the sessions, so only this process expires them
+    loop.add_callback(lambda: tornado.ioloop.PeriodicCallback(expire_sessions, 60*1000).start())
+    if simulate is not None:
+        # Headless: no VLC, no yt-dlp, every track lasts simulate seconds
+        resolver = StubResolver(simulate)
+        player_args = dict(player_args or {})
+        player_args['backend'] = functools.partial(SimulatedBackend, track_seconds=simulate)
+        player_args['probe_fallback'] = False
+    else:
+        resolver = Resolver(**(resolver_args or {}))
+    metrics.gauge('mp3printer_link_lookups', 'yt-dlp lookups: cache hits, misses, shared, errors, cached and in flight',
+        resolver.stats, 'stat')
+    if prefetch_args is not None:
+        prefetcher = Prefetcher(**prefetch_args)
+        metrics.gauge('mp3printer_prefetch', 'Prefetched links: hits, misses, downloads, errors, evictions, and files, bytes and budget on disk',
+            prefetcher.stats, 'stat')
+    if extract_args is not None:
+        extractor = AudioExtractor(**extract_args)
+        metrics.gauge('mp3printer_audio_extraction', 'Uploaded videos whose audio was extracted, failures, and disk space saved',
+            extractor.stats, 'stat')
+    if loudness_args is not None:
+        analyzer = LoudnessAnalyzer(resolver, prefetcher, **loudness_args)
+        metrics.gauge('mp3printer_loudness_analysis', 'Loudness measurements: cache hits, misses, shared, errors, and gains cached',
+            analyzer.stats, 'stat')
+    if socket_path is not None:
+        playback_server = PlaybackServer(loop, socket_path, {
+            'command': remote_command,
+            'upload': queue_upload,
+            'download': download_info,
+            'snapshot': snapshot_json,
+            'metrics': metrics_text,
+            'reserve': reserve_disk,
+            'release': release_disk,
+        })
+        metrics.gauge('mp3printer_workers', 'Connected frontend processes', playback_server.count)
+        metrics.gauge('mp3printer_worker_fanout', 'Messages dropped for, and disconnects of, workers too far behind',
+            playback_server.stats, 'stat')
+    else:
+        client_gauges()
+
+    # Rooms share the resolver, prefetcher, extractor, analyzer and upload writer, nothing else
+    for name, args in (room_args or {'': {}}).items():
+        if socket_path is not None:
+            clients = playback_server.publisher(name)
+        else:
+            clients = Connections(loop)
+        juggler = mp3Juggler(loop, clients, resolver, dict(player_args or {}, **args), prefetcher, max_queued, extractor, analyzer, budget)
+        rooms[name] = Room(name, clients, juggler)
+
+    metrics.gauge('mp3printer_queue_length', 'Tracks in the queue',
+        per_room(lambda room: room.juggler.queue_length()), 'room')
+    metrics.gauge('mp3printer_queued_by_address', 'Tracks in the queue per address',
+        lambda: {
+            (name, address): count
+            for name, room in list(rooms.items())
+            for address, count in room.juggler.counts().items()
+        },
+        ('room', 'address'))
+    metrics.gauge('mp3printer_waiting_for_parent', 'Tracks waiting for their parent track',
+        per_room(lambda room: room.juggler.waiting_count()), 'room')
+    metrics.gauge('mp3printer_transition_gap_last_seconds', 'Silence before the latest track',
+        per_room(lambda room: room.juggler.player_stats().get('gap_last', 0)), 'room')
+    metrics.gauge('mp3printer_player', 'Player: link stream cache hits and misses, gapless swaps, transitions and their gaps in seconds, fallback sources alive and dead',
+        lambda: {
+            (name, stat): value
+            for name, room in list(rooms.items())
+            for stat, value in room.juggler.player_stats().items()
+        },
+        ('room', 'stat'))
+
+    if socket_path is None:
+        serve(port, bind)
 
     threading.Thread(target=loop.start).start()
-    juggler.start()
+    for room in rooms.values():
+        room.juggler.start()
+    metrics.phase('started')
+
+# A --workers frontend: serves HTTP and websockets on a port it shares with
+# the other frontends, and sends everything else to the playback process.
+def start_worker(port, bind, socket_path, names):
+    global loop, writer, sessions, playback
+    loop = tornado.ioloop.IOLoop.current()
+    writer = UploadWriter()
+    sessions = UploadSessions(writer, SESSION_DIR)
+    for name in names:
+        rooms[name] = Room(name, Connections(loop))
+    playback = PlaybackClient({name: room.clients for name, room in rooms.items()}, socket_path)
+    loop.run_sync(playback.connect)
+    client_gauges()
+    serve(port, bind, reuse_port=True)
+
+def run_worker(port, bind, socket_path, names):
+    # Forked, so must never return into the parent's code
+    def signal_handler(sig, frame):
+        loop.add_callback(loop.stop)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    try:
+        start_worker(port, bind, socket_path, names)
+        loop.start()
+    except Exception as err:
+        print('Error in frontend process:', err)
+    finally:
+        if sessions is not None:
+            sessions.stop()
+        if writer is not None:
+            writer.stop()
+        os._exit(0)
 
 def stop():
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
     if loop is not None:
         # Should use add_callback_from_signal according to documentation, but it's deprecated
         # on master (since 2023-05-02), and add_callback should have the same effect since 6.0.
         loop.add_callback(lambda: loop.stop())
     if http_server is not None:
         http_server.stop()
-    if juggler is not None:
-        juggler.stop()
+    if playback_server is not None:
+        playback_server.stop()
+    for room in list(rooms.values()):
+        if room.juggler is not None:
+            room.juggler.stop()
+    if resolver is not None:
+        resolver.stop()
+    if prefetcher is not None:
+        prefetcher.stop()
+    if extractor is not None:
+        extractor.stop()
+    if analyzer is not None:
+        analyzer.stop()
+    if sessions is not None:
+        sessions.stop()
+    if writer is not None:
+        writer.stop()
 
 
 if __name__ == "__main__":
@@ -258,6 +874,124 @@ if __name__ == "__main__":
             action='store_true',
             help='List available Chromecast (and Chromecast group) names and exit.'
         )
+    parser.add_argument(
+        '--room',
+        type=str,
+        action='append',
+        metavar='NAME[=CHROMECAST]',
+        help='Add a room with a queue and player of its own at /r/NAME/, playing locally or on the given Chromecast (can be repeated)',
+        default=[]
+    )
+    parser.add_argument(
+        '--resolver-workers',
+        type=int,
+        help='Number of links to look up in parallel (default 4)',
+        default=4
+    )
+    parser.add_argument(
+        '--resolver-cache-size',
+        type=int,
+        help='Number of looked up links to remember (default 256)',
+        default=256
+    )
+    parser.add_argument(
+        '--resolver-cache-ttl',
+        type=int,
+        help='Seconds to remember a looked up link (default 1800)',
+        default=1800
+    )
+    parser.add_argument(
+        '--prefetch-budget',
+        type=int,
+        help='Download queued links into a local cache of this many MiB (default 0, disabled)',
+        default=0
+    )
+    parser.add_argument(
+        '--prefetch-dir',
+        type=str,
+        help='Directory for the local link cache (default: mp3printer-cache in the temp dir)',
+        default=os.path.join(tempfile.gettempdir(), 'mp3printer-cache')
+    )
+    parser.add_argument(
+        '--disk-budget',
+        type=int,
+        help='MiB of disk all uploads together may take while queued (default: half the free space in the temp directory at startup, 0 for no limit)',
+        default=None
+    )
+    parser.add_argument(
+        '--disk-quota',
+        type=int,
+        help='MiB of disk the uploads of one user may take while queued (default 0, no limit)',
+        default=0
+    )
+    parser.add_argument(
+        '--extract-audio',
+        action='store_true',
+        help='Replace uploaded videos with just their audio (needs ffmpeg)'
+    )
+    parser.add_argument(
+        '--extract-audio-bitrate',
+        type=int,
+        help='Re-encode extracted audio to Opus at this many kbit/s (default 0, keep the audio as it is)',
+        default=0
+    )
+    parser.add_argument(
+        '--loudness',
+        action='store_true',
+        help='Measure the loudness of queued tracks and play them all equally loud (needs ffmpeg)'
+    )
+    parser.add_argument(
+        '--loudness-target',
+        type=float,
+        help='Loudness to play tracks at, in LUFS (default -18)',
+        default=-18.0
+    )
+    parser.add_argument(
+        '--loudness-cache',
+        type=str,
+        help='File to keep measured loudness in across restarts (default: only in memory)',
+        default=None
+    )
+    parser.add_argument(
+        '--max-queued',
+        type=int,
+        help='Tracks one user may have queued at a time, playlists included (default 100, 0 for no limit)',
+        default=100
+    )
+    parser.add_argument(
+        '--crossfade',
+        type=float,
+        metavar='SECONDS',
+        help='Fade between queued tracks for this long (default 0, not with Chromecast)',
+        default=0
+    )
+    parser.add_argument(
+        '--ws-compression',
+        type=int,
+        metavar='LEVEL',
+        help='Compress websocket messages (permessage-deflate) at this zlib level, 1-9 (default 0, off)',
+        default=0
+    )
+    parser.add_argument(
+        '--ws-compression-memory',
+        type=int,
+        metavar='LEVEL',
+        help='zlib memory level for websocket compression, 1-9, more is faster and compresses better (default 8)',
+        default=8
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Serve clients from this many processes, with playback in another (default 0: all in one)',
+        default=0
+    )
+    parser.add_argument(
+        '--simulate',
+        type=float,
+        metavar='TRACK_SECONDS',
+        help='Run without VLC or network access, pretending every track lasts this long (for benchmarks)',
+        default=None
+    )
     parser.add_argument(
         'port',
         type=int,
@@ -266,10 +1000,46 @@ if __name__ == "__main__":
         default=80
     )
     args = parser.parse_args()
+    metrics.phase('imported')
 
-    player_args = {}
+    player_args = {'crossfade': args.crossfade}
+    resolver_args = {
+        'workers': args.resolver_workers,
+        'cache_size': args.resolver_cache_size,
+        'cache_ttl': args.resolver_cache_ttl
+    }
+    prefetch_args = None
+    if args.prefetch_budget > 0:
+        prefetch_args = {
+            'directory': args.prefetch_dir,
+            'budget': args.prefetch_budget*1024*1024
+        }
+    budget_args = {
+        'budget': args.disk_budget*1024*1024 if args.disk_budget is not None else None,
+        'per_address': args.disk_quota*1024*1024
+    }
+    extract_args = None
+    if args.extract_audio:
+        extract_args = {'bitrate': args.extract_audio_bitrate}
+    loudness_args = None
+    if args.loudness:
+        loudness_args = {'target': args.loudness_target, 'cache_file': args.loudness_cache}
 
-    if HAS_PYCHROMECAST:
+    # Room name -> Chromecast name (or None), '' is the default room
+    casts = {'': args.chromecast if HAS_PYCHROMECAST else None}
+    for room in args.room:
+        name, sep, cast = room.partition('=')
+        if not ROOM_NAME.match(name) or name in casts:
+            print('Room names must be unique and only letters, digits, _ and -: "%s"' % name)
+            exit(1)
+        if cast and not HAS_PYCHROMECAST:
+            print('Casting room "%s" needs pychromecast' % name)
+            exit(1)
+        casts[name] = cast or None
+
+    room_args = {name: {} for name in casts}
+    if HAS_PYCHROMECAST and (args.chromecast_list or any(casts.values())):
+        import pychromecast.discovery
         if args.chromecast_list:
             print('Available Chromecast targets:')
             services, browser = pychromecast.discovery.discover_chromecasts()
@@ -278,33 +1048,50 @@ if __name__ == "__main__":
                 print('* \"%s\"' % service.friendly_name)
             exit(0)
 
-        if args.chromecast is not None:
+        for name, cast in casts.items():
+            if cast is None:
+                continue
             services, browser = pychromecast.discovery.discover_listed_chromecasts(
-                friendly_names=[args.chromecast]
+                friendly_names=[cast]
             )
             pychromecast.discovery.stop_discovery(browser)
             if len(services) < 1:
-                print('Could not find Chromecast (or group) "%s"' % args.chromecast)
+                print('Could not find Chromecast (or group) "%s"' % cast)
                 exit(1)
             elif len(services) > 1:
-                print('More than one Chromecast (or group) matched "%s"' % args.chromecast)
+                print('More than one Chromecast (or group) matched "%s"' % cast)
                 exit(1)
 
-            player_args['chromecast'] = (services[0].host, services[0].port)
+            room_args[name]['chromecast'] = (services[0].host, services[0].port)
 
     if args.proxied:
         remote_ip = forwarded_remote_ip
+    if args.ws_compression > 0:
+        ws_compression = {
+            'compression_level': args.ws_compression,
+            'mem_level': args.ws_compression_memory
+        }
 
     def signal_handler(sig, frame):
         print("\nSignal caught, exiting...")
         stop()
         exit(0)
 
+    # Forked before anything starts a thread
+    socket_path = None
+    if args.workers > 0:
+        socket_path = os.path.join(tempfile.gettempdir(), 'mp3printer-%d.sock' % os.getpid())
+        for i in range(args.workers):
+            pid = os.fork()
+            if pid == 0:
+                run_worker(args.port, args.bind, socket_path, list(room_args))
+            workers.append(pid)
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        start(args.port, args.bind, player_args)
+        start(args.port, args.bind, player_args, resolver_args, prefetch_args, args.simulate, args.max_queued, socket_path, room_args, extract_args, loudness_args, budget_args)
         print('*** Web Server Started on %s:%s***' % (
             args.bind or '*',
             args.port
@@ -314,15 +1101,20 @@ if __name__ == "__main__":
         exit(1)
 
 
-    # Start console
+    # Start console, commands are followed by a room name for other rooms
     while True:
-        inp = input()
-        if (inp == "s"):
+        inp = input().split(maxsplit=1)
+        if not inp:
+            continue
+        room = rooms.get(inp[1] if len(inp) > 1 else '')
+        if room is None:
+            print("No such room")
+        elif (inp[0] == "s"):
             print("Skipping...")
-            juggler.skip()
-        elif (inp == "c"):
+            room.juggler.skip()
+        elif (inp[0] == "c"):
             print("Clearing...")
-            juggler.clear()
-        elif (inp == "p"):
+            room.juggler.clear()
+        elif (inp[0] == "p"):
             print("Toggling pause...")
-            juggler.pause()
+            room.juggler.pause()
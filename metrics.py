@@ -0,0 +1,151 @@
+from threading import Lock, RLock, get_ident
+import time
+
+# Minimal Prometheus metrics: histograms that are observed as things happen,
+# and gauges that are read through a callback when /metrics is scraped.
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+_metrics = []
+_started = time.monotonic()
+_phases = {}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Histogram:
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self._buckets = tuple(buckets) + (float('inf'),)
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self.lock.acquire()
+        try:
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i]+= 1
+                    break
+            self._sum+= value
+        finally:
+            self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        try:
+            counts = list(self._counts)
+            total = self._sum
+        finally:
+            self.lock.release()
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s histogram' % self.name
+        ]
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative+= count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, _number(bound), cumulative))
+        lines.append('%s_sum %s' % (self.name, _number(total)))
+        lines.append('%s_count %d' % (self.name, cumulative))
+        return lines
+
+# read() returns a number, or if label is given, a dict of label value -> number.
+# label can also be a tuple of labels, then the dict keys are tuples of values.
+class Gauge:
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self._read = read
+        self._label = label
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s gauge' % self.name
+        ]
+        value = self._read()
+        if self._label is None:
+            lines.append('%s %s' % (self.name, _number(value)))
+        else:
+            labels = self._label if isinstance(self._label, tuple) else (self._label,)
+            for key, item in sorted(value.items()):
+                values = key if isinstance(self._label, tuple) else (key,)
+                pairs = ','.join('%s="%s"' % (label, _escape(v)) for label, v in zip(labels, values))
+                lines.append('%s{%s} %s' % (self.name, pairs, _number(item)))
+        return lines
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+    metric = Histogram(name, help, buckets)
+    _metrics.append(metric)
+    return metric
+
+def gauge(name, help, read, label=None):
+    metric = Gauge(name, help, read, label)
+    _metrics.append(metric)
+    return metric
+
+def render():
+    lines = []
+    for metric in list(_metrics):
+        try:
+            lines.extend(metric.render())
+        except Exception as err:
+            print('Could not read metric %s: %s' % (metric.name, err))
+    return '\n'.join(lines) + '\n'
+
+# Logs (once) how long after startup the named phase was reached
+def phase(name):
+    if name not in _phases:
+        _phases[name] = time.monotonic() - _started
+        print('Startup: %s after %.3fs' % (name, _phases[name]))
+
+gauge('mp3printer_startup_seconds', 'Time from startup until each phase was reached',
+    lambda: dict(_phases), 'phase')
+
+# An RLock that records how long it takes to get, and how long it is held
+class TimedRLock:
+    def __init__(self, wait, hold):
+        self._lock = RLock()
+        self._wait = wait
+        self._hold = hold
+        self._depth = 0         # Only touched by the thread holding the lock
+        self._owner = None
+        self._since = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.monotonic()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._depth+= 1
+            if self._depth == 1:
+                self._owner = get_ident()
+                self._since = time.monotonic()
+                self._wait.observe(self._since - start)
+        return acquired
+
+    def release(self):
+        # Another thread releasing must fail without touching the holder's depth
+        if self._owner != get_ident():
+            raise RuntimeError('cannot release un-acquired lock')
+        if self._depth == 1:
+            self._hold.observe(time.monotonic() - self._since)
+            self._owner = None
+        self._depth-= 1
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
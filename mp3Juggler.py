@@ -1,223 +1,568 @@
 import os
-from threading import Thread, Event, RLock, Condition
+from threading import Thread, Event
 import time
 import uuid
 
 # local libs
+import metrics
+from ingest import HandedOverFile, SharedHandle
 from player import Player
+from resolver import LookAhead
+from songqueue import SongQueue, QueueSnapshot
+
+LOCK_WAIT_SECONDS = metrics.histogram(
+    'mp3printer_juggler_lock_wait_seconds',
+    'Time spent waiting for the juggler lock'
+)
+LOCK_HOLD_SECONDS = metrics.histogram(
+    'mp3printer_juggler_lock_hold_seconds',
+    'Time the juggler lock was held'
+)
 
 class mp3Juggler:
-    def __init__(self, clients, player_args=None):
+    # How often to check the player for drift when nothing else happens,
+    # and how far (in ms) it may drift before clients get a new anchor.
+    ANCHOR_CHECK = 5
+    DRIFT_TOLERANCE = 1000
+    # How long a track waits for the track it should follow to show up
+    PARENT_TIMEOUT = 30
+
+    # max_queued limits how many tracks one address may have queued (0: no limit),
+    # with an extractor (transcode.AudioExtractor) uploaded videos are swapped
+    # for their audio once it has been extracted, and with an analyzer
+    # (loudness.LoudnessAnalyzer) tracks are played at their measured gain.
+    # Uploads may hold a 'reservation' of budget (ingest.DiskBudget), which is
+    # released once their file is gone.
+    def __init__(self, ioloop, clients, resolver, player_args=None, prefetcher=None, max_queued=0, extractor=None, analyzer=None, budget=None):
+        self._ioloop = ioloop
         self._clients = clients
-        self._player_args = player_args
-        self._songlist = []
+        self._resolver = resolver
+        self._prefetcher = prefetcher
+        self._extractor = extractor
+        self._analyzer = analyzer
+        self._budget = budget
+        self._max_queued = max_queued
+        self._lookahead = LookAhead(resolver)
+        self._player_args = player_args or {}
+        self._player = None
+        self._songlist = SongQueue()
         self._counts = {}
         self._event = Event()
-        self._waiting = {}
+        self._anchor_event = Event()
+        self._anchor = None
+        self._playing_id = None
+        self._starting = None   # The track play_next is about to start
+        self._play_head = False
+        self._waiting = {}      # Parent upload id -> tracks waiting for it
+        self._files = {}        # Content hash -> SharedHandle of a queued upload
+        self._reserved = {}     # Content hash -> budget reservation of that file
         self._running = False
-        self.lock = RLock()
+        self._version = 0
+        self.lock = metrics.TimedRLock(LOCK_WAIT_SECONDS, LOCK_HOLD_SECONDS)
+        self._update_snapshot()
 
-    def _remove_song(self, i, song = None):
-        if song is None:
-            song = self._songlist[i]
+    def _remove_song(self, song):
         self._counts[song['address']]-= 1
-        if 'handle' in song:
-            try:
-                song['handle'].close()
-            except:
-                pass
-        del(self._songlist[i])
+        if self._counts[song['address']] == 0:
+            del(self._counts[song['address']])
+        if self._prefetcher is not None and song['type'] == 'link':
+            self._prefetcher.dequeued(song['mrl'])
+        self._close_handle(song)
+        self._songlist.remove(song)
 
     def start(self):
         if not self._running:
-            self._player = Player(self, **self._player_args);
+            self._lookahead.start()
             self._next_thread = Thread(target=self.play_next, args=())
-            self._progress_thread = Thread(target=self.time_change, args=())
+            self._anchor_thread = Thread(target=self.watch_playback, args=())
             self._running = True
+            # The play_next thread creates the player and starts the fallback
+            self._event.set()
             self._next_thread.start()
-            self._progress_thread.start()
-            self._clients.message_clients(self.get_list())
+            self._anchor_thread.start()
+            self._publish_list()
 
     def stop(self):
         if self._running:
             self._running = False
             self._event.set()
+            self._anchor_event.set()
             self.clear()
             self._next_thread.join()
-            self._progress_thread.join()
-            self._player.release()
+            self._anchor_thread.join()
+            self._lookahead.stop()
+            if self._player is not None:
+                self._player.release()
 
     def skip(self):
         self.lock.acquire()
         try:
-            self._player.scratch()
+            self._playing_id = None
+            self._play_head = False
+            if self._player is not None:
+                self._player.scratch()
         finally:
             self.lock.release()
 
     def pause(self):
         self.lock.acquire()
         try:
-            self._player.pause()
+            if self._player is not None:
+                self._player.pause()
         finally:
             self.lock.release()
 
     def juggle(self, infile, parent_id = None):
+        self.juggle_batch([infile], parent_id)
+
+    # Queues infiles (all from the same address) in order, each following the
+    # one before it, as one change: clients get a single message for all.
+    def juggle_batch(self, infiles, parent_id = None):
         if not self._running:
             raise Exception('Queue is not running')
+        if not infiles:
+            return
 
-        Thread(target=self._juggle, args=(infile, parent_id)).start()
+        self.lock.acquire()
+        try:
+            self.check_quota(infiles[0]['address'], len(infiles))
+            if parent_id is not None and self._songlist.by_upload(parent_id) is None:
+                # Parked until the parent arrives, or gives up after a while
+                self._waiting.setdefault(parent_id, []).append(infiles)
+                self._ioloop.add_callback(
+                    self._ioloop.call_later,
+                    self.PARENT_TIMEOUT,
+                    self._parent_timeout,
+                    parent_id,
+                    infiles
+                )
+                return
+            # A track can release a chain of tracks waiting for each other
+            inserts = []
+            pending = list(infiles)
+            while pending:
+                infile = pending.pop(0)
+                inserts.append(self._juggle(infile))
+                if 'upload_id' in infile:
+                    released = self._waiting.pop(infile['upload_id'], [])
+                    pending[0:0] = [song for batch in released for song in batch]
+            if len(inserts) == 1:
+                self._publish(dict(inserts[0], type='insert'))
+            else:
+                self._publish({'type': 'inserts', 'items': inserts})
+        finally:
+            self.lock.release()
+
+    # Raises if address may not queue count more tracks, counting parked ones too
+    def check_quota(self, address, count=1):
+        if self._max_queued <= 0:
+            return
+        queued = self._counts.get(address, 0) + sum(
+            1 for waiting in list(self._waiting.values())
+            for batch in waiting for song in batch if song['address'] == address
+        )
+        if queued + count > self._max_queued:
+            raise Exception('You already have %d tracks queued, please wait for some to play' % queued)
 
-    def _juggle(self, infile, parent_id):
+    def _parent_timeout(self, parent_id, infiles):
         self.lock.acquire()
         try:
-            if parent_id is not None:
-                for i, song in reversed(list(enumerate(self._songlist))):
-                    if 'upload_id' in song and song['upload_id'] == parent_id:
-                        break
-                else:  # Not found
-                    if not parent_id in self._waiting:
-                        self._waiting[parent_id] = [Condition(self.lock), False]
-                    wait = self._waiting[parent_id]
-                    if not (wait[0].wait(30) and wait[1]):
-                        if 'handle' in infile:
-                            infile['handle'].close()
-                        return False
-
-            infile['prio'] = self._counts.get(infile['address'], 0) + 1
-            self._counts[infile['address']] = self._counts.get(infile['address'], 0) + 1
-            infile['prio'] = max(infile['prio'] - 3, 0)
-            index = 0
-            if len(self._songlist) > 0:
-                index = 1
-                for item in self._songlist[1:]:
-                    if(item['prio']>infile['prio']):
-                        break
-                    index+= 1
-            extn = infile['extn'] if 'extn' in infile else ''
-            infile['id'] = str(uuid.uuid4()) + extn
-            self._songlist.insert(index, infile)
-
-            if len(self._songlist) == 1:
-                self._player.play(infile)
-
-            if 'upload_id' in infile and infile['upload_id'] in self._waiting:
-                wait = self._waiting[infile['upload_id']]
-                wait[1] = True
-                wait[0].notify_all()
-                del(self._waiting[infile['upload_id']])
+            waiting = self._waiting.get(parent_id, [])
+            for i, batch in enumerate(waiting):
+                if batch is infiles:
+                    print('Gave up waiting for parent of %s' % infiles[0]['filename'])
+                    del(waiting[i])
+                    if not waiting:
+                        del(self._waiting[parent_id])
+                    for infile in infiles:
+                        self._close_handle(infile)
+                    break
         finally:
             self.lock.release()
-        self._clients.message_clients(self.get_list())
 
-    def download(self, track_id):
+    def _release(self, reservation):
+        if self._budget is not None and reservation is not None:
+            self._budget.release(reservation)
+
+    def _close_handle(self, song):
+        # Still on the song if it never got to share a file
+        self._release(song.pop('reservation', None))
+        if 'handle' in song:
+            try:
+                song['handle'].close()
+            except:
+                pass
+            if 'hash' in song and self._files.get(song['hash']) is song['handle']:
+                if song['handle'].closed:
+                    del(self._files[song['hash']])
+                    self._release(self._reserved.pop(song['hash'], None))
+
+    def _share_file(self, infile):
+        # Must be called with the lock held. Identical uploads share the
+        # temp file of the first one, instead of keeping a copy each.
+        shared = self._files.get(infile['hash'])
+        if shared is not None and shared.share() is not None:
+            infile['handle'].close()
+            infile['handle'] = shared
+            infile['mrl'] = shared.name
+            self._release(infile.pop('reservation', None))
+        else:
+            infile['handle'] = SharedHandle(infile['handle'])
+            self._files[infile['hash']] = infile['handle']
+            self._reserved[infile['hash']] = infile.pop('reservation', None)
+            if self._extractor is not None and infile.get('video'):
+                handle = infile['handle']
+                self._extractor.extract(handle.name).add_done_callback(
+                    lambda future: self._extracted(handle, future))
+
+    def _extracted(self, handle, future):
+        # Called on an extractor thread. Tracks keep playing the original
+        # until this swaps in the audio for every track sharing the file.
+        try:
+            path = future.result()
+        except Exception:
+            return
         self.lock.acquire()
         try:
-            for song in self._songlist:
-                if song['id'] == track_id:
-                    return {
-                        'type': song['type'],
-                        'filename': song['filename'],
-                        'mrl': song['mrl']
-                    }
-            else:  # Not found
-                return None
+            songs = [song for song in self._songlist if song.get('handle') is handle]
+            # A backend may be opening the original right now, keep it until
+            # the track is gone
+            busy = any(song is self._songlist.head() or song is self._songlist.next_up() for song in songs)
+            kept = os.path.getsize(handle.name) if busy else 0
+            if not handle.replace(HandedOverFile(path), busy):
+                return
+            for song in songs:
+                song['mrl'] = path
+                song['extracted'] = True
+            # While the original is kept, both are on disk
+            reservation = self._reserved.get(songs[0]['hash'])
+            if self._budget is not None and reservation is not None:
+                self._budget.resize(reservation, kept + os.path.getsize(path))
         finally:
             self.lock.release()
 
+    def _juggle(self, infile):
+        # Must be called with the lock held, returns the insert for clients
+        infile['prio'] = self._counts.get(infile['address'], 0) + 1
+        self._counts[infile['address']] = self._counts.get(infile['address'], 0) + 1
+        infile['prio'] = max(infile['prio'] - 3, 0)
+        extn = infile['extn'] if 'extn' in infile else ''
+        infile['id'] = str(uuid.uuid4()) + extn
+        if 'hash' in infile:
+            self._share_file(infile)
+        index = self._songlist.insert(infile)
+        if self._prefetcher is not None and infile['type'] == 'link':
+            self._prefetcher.queued(infile['mrl'])
+        if self._analyzer is not None:
+            self._analyzer.analyze(infile).add_done_callback(
+                lambda future: self._analyzed(infile, future))
+
+        if index == 0:
+            # Starting playback may have to resolve a link, leave that
+            # to the play_next thread instead of blocking the caller
+            self._play_head = True
+            self._event.set()
+        return {
+            'index': index,
+            'item': self._sanitize_item(infile)
+        }
+
+    def _analyzed(self, song, future):
+        # Called on an analyzer thread, or from _juggle (with the lock held,
+        # the track already queued) if the gain was cached. Doesn't need the
+        # lock, the player only reads the gain.
+        try:
+            gain = future.result()
+        except Exception:
+            return
+        if gain is None:
+            return
+        song['gain_db'] = gain
+        player = self._player
+        if player is not None:
+            player.gain_changed(song)
+
+    def download(self, track_id):
+        song = self.get_snapshot().tracks.get(track_id)
+        if song is None:
+            return None
+        if self._prefetcher is not None and song['type'] == 'link':
+            path = self._prefetcher.lookup(song['mrl'])
+            if path is not None:
+                return {
+                    'type': 'file',
+                    'filename': song['filename'] + os.path.splitext(path)[-1],
+                    'mrl': path
+                }
+        filename = song['filename']
+        if song.get('extracted'):
+            filename = os.path.splitext(filename)[0] + os.path.splitext(song['mrl'])[-1]
+        return {
+            'type': song['type'],
+            'filename': filename,
+            'mrl': song['mrl']
+        }
+
     def cancel(self, infile):
         self.lock.acquire()
         try:
-            for i, song in list(enumerate(self._songlist)):
-                if(song['id']==infile['id'] and song['address']==infile['address']):
-                    if(i==0):
-                        self.skip()
-                    else:
-                        self._remove_song(i, song)
-                    break
+            song = self._songlist.get(infile['id'])
+            if(song is not None and song['address']==infile['address']):
+                if(song is self._songlist.head()):
+                    self.skip()
+                else:
+                    self._remove_song(song)
+                    self._publish({
+                        'type': 'remove',
+                        'id': song['id']
+                    })
         finally:
             self.lock.release()
-        self._clients.message_clients(self.get_list())
 
     def clear(self):
         self.lock.acquire()
         try:
-            for wait in self._waiting.values():
-                wait[1] = False
-                wait[0].notify_all()
+            for waiting in self._waiting.values():
+                for batch in waiting:
+                    for infile in batch:
+                        self._close_handle(infile)
             self._waiting.clear()
-            for i, song in reversed(list(enumerate(self._songlist))):
-                if(i==0):
+            for song in reversed(list(self._songlist)):
+                if(song is self._songlist.head()):
                     self.skip()
-                self._remove_song(i, song)
+                self._remove_song(song)
+            self._publish_list()
         finally:
             self.lock.release()
-        self._clients.message_clients(self.get_list())
 
     def song_finished(self, event=None, player=None):
         self._event.set()
 
-    def time_change(self):
+    def playback_changed(self, event=None, player=None):
+        # Called from VLC's event thread, which must not call back into VLC
+        self._anchor_event.set()
+
+    def watch_playback(self):
         while self._running:
-            time.sleep(1)
-            self.send_progress()
+            self._anchor_event.wait(self.ANCHOR_CHECK)
+            self._anchor_event.clear()
+            if not self._running:
+                break
+            self.send_anchor()
+
+    def get_anchor(self):
+        return self._anchor
+
+    def send_anchor(self):
+        # Clients extrapolate progress from the last anchor, so only send a
+        # new one when the track or play state changes, or the clock drifts.
+        if self._player is None:
+            return
+        anchor = {
+            'type': 'anchor',
+            'track': self._playing_id,
+            'position': max(self._player.get_time(), 0),
+            'duration': max(self._player.get_length(), 0),
+            'playing': self._player.is_playing(),
+            'time': int(time.time()*1000)
+        }
+        last = self._anchor
+        if (last is not None and last['track'] == anchor['track']
+                and last['playing'] == anchor['playing']
+                and last['duration'] == anchor['duration']):
+            expected = last['position']
+            if last['playing']:
+                expected+= anchor['time'] - last['time']
+            if abs(anchor['position'] - expected) <= self.DRIFT_TOLERANCE:
+                return
+        self._anchor = anchor
+        self._clients.message_clients(anchor)
 
-    def send_progress(self):
+
+    def play_next(self):
+        # Loading libvlc takes a while, so it's done here rather than in start()
+        try:
+            player = Player(self, self._resolver, self._prefetcher, **self._player_args)
+        except Exception as err:
+            print('Could not start the player: %s' % err)
+            # Stopping joins this thread, so leave it to the IOLoop. Clients
+            # see the queue as not active, and new tracks are turned away.
+            self._ioloop.add_callback(self.stop)
+            return
         self.lock.acquire()
         try:
-            position = self._player.get_position();
+            self._player = player
         finally:
             self.lock.release()
-        if position > 0:
-            self._clients.message_clients({'type': 'progress', 'position': position})
-
+        metrics.phase('player ready')
 
-    def play_next(self):
         while self._running:
             self._event.wait()
             self._event.clear()
             if not self._running:
                 break
-            self.lock.acquire()
-            try:
+            track = self._advance()
+            if track is not None:
+                self._play(track)
+
+    # Moves the queue on, returns the track to play (None for a fallback)
+    def _advance(self):
+        self.lock.acquire()
+        try:
+            play_head = self._play_head
+            self._play_head = False
+            if(play_head and self._songlist):
+                self._playing_id = self._songlist.head()['id']
+                self._starting = self._songlist.head()
+                return self._starting
+            elif(not self._songlist):
+                self._playing_id = None
+                self._player.play_fallback()
+                self._publish_list()
+            else:
+                self._remove_song(self._songlist.head())
                 if(not self._songlist):
+                    self._playing_id = None
                     self._player.play_fallback()
+                    self._publish_list()
                 else:
-                    self._remove_song(0)
-                    if(not self._songlist):
-                        self._player.play_fallback()
-                    else:
-                        self._player.play(self._songlist[0])
+                    self._playing_id = self._songlist.head()['id']
+                    self._starting = self._songlist.head()
+                    self._publish({'type': 'advance'})
+                    return self._starting
+        finally:
+            self.lock.release()
+        return None
+
+    def _play(self, track):
+        # Looking up a link can take seconds, which is done without the lock,
+        # so the track may have been skipped by the time it can play.
+        while self._running:
+            try:
+                mrl = self._player.prepare(track)
+            except Exception as err:
+                print(err)
+                mrl = None
+                failed = True
+            else:
+                failed = False
+            self.lock.acquire()
+            try:
+                if self._playing_id != track['id']:
+                    break
+                if failed:
+                    self.song_finished()
+                    break
+                if self._player.play(track, mrl):
+                    break
             finally:
                 self.lock.release()
-            self._clients.message_clients(self.get_list())
+        self.lock.acquire()
+        try:
+            if self._starting is track:
+                self._starting = None
+                self._preload_next()
+        finally:
+            self.lock.release()
+
+    def _preload_next(self):
+        # Must be called with the lock held. Until the head has started, the
+        # standby may have it loaded, the track after it has to wait.
+        if self._player is not None:
+            self._player.preload(self._starting or self._songlist.next_up())
+
+    def _publish(self, message):
+        # Must be called with the lock held, so clients see versions in order
+        self._version+= 1
+        message['version'] = self._version
+        self._update_snapshot()
+        self._clients.message_clients(message)
+        self._lookahead.update(self._songlist)
+        self._preload_next()
+
+    def _publish_list(self):
+        self._version+= 1
+        self._update_snapshot()
+        snapshot = self.get_snapshot()
+        self._clients.message_clients(snapshot.message, snapshot.json)
+        self._lookahead.update(self._songlist)
+        self._preload_next()
+
+    def _update_snapshot(self):
+        # Must be called with the lock held, after every change to the queue.
+        # Only drops the stale snapshot, the next read makes a new one, so a
+        # run of changes nobody looks at in between costs nothing per change.
+        self._snapshot = None
+
+    def _make_snapshot(self):
+        # Must be called with the lock held
+        if(self._songlist):
+            message = {
+                'type': 'list',
+                'version': self._version,
+                'list': [self._sanitize_item(song) for song in self._songlist]
+            }
+        else:
+            if(self._running):
+                if(self._player is None):
+                    filename = "Starting up..."
+                elif(self._player._playingDubstep):
+                    filename = "Now playing dubstep..."
+                else:
+                    filename = "Now playing Slay Radio..."
+            else:
+                filename = "Not active"
+            message = {
+                'type': 'fallback',
+                'version': self._version,
+                'filename': filename
+            }
+        return QueueSnapshot(message, self._songlist.tracks())
 
     def _sanitize_item(self, item):
-        return {
-            'id': item['id'],
-            'filename': item['filename'],
-            'nick': item['nick'],
-            'address': item['address'],
-            'prio': item['prio']
-        }
+        # Computed once per song, snapshots are rebuilt after every change
+        if 'public' not in item:
+            item['public'] = {
+                'id': item['id'],
+                'filename': item['filename'],
+                'nick': item['nick'],
+                'address': item['address'],
+                'prio': item['prio']
+            }
+        return item['public']
 
-    def get_list(self):
+    def queue_length(self):
+        return len(self._songlist)
+
+    def counts(self):
         self.lock.acquire()
         try:
-            if(self._songlist):
-                position = self._player.get_position();
-                return {
-                    'type': 'list',
-                    'position': position,
-                    'list': list(map(self._sanitize_item, self._songlist))
-                }
-            else:
-                if(self._running):
-                    if(self._player._playingDubstep):
-                        message = "Now playing dubstep..."
-                    else:
-                        message = "Now playing Slay Radio..."
-                else:
-                    message = "Not active"
-                return { 'type': 'fallback', 'filename': message}
+            return dict(self._counts)
+        finally:
+            self.lock.release()
+
+    def player_stats(self):
+        if self._player is None:
+            return {}
+        return self._player.stats()
+
+    def waiting_count(self):
+        return sum(len(batch) for waiting in list(self._waiting.values()) for batch in waiting)
+
+    # The read path (get_list, download) only takes the lock for the first
+    # read after a change, to make the snapshot. Snapshots are replaced (not
+    # changed) on every update, so later reads share it without the lock.
+    def get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        self.lock.acquire()
+        try:
+            if self._snapshot is None:
+                self._snapshot = self._make_snapshot()
+            return self._snapshot
         finally:
             self.lock.release()
+
+    def get_list(self):
+        return self.get_snapshot().message
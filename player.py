@@ -1,19 +1,25 @@
-import vlc
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock, Thread, Timer
 import random
-import yt_dlp
+import time
 
-class Player:
+# local libs
+import metrics
+from resolver import FallbackWarmer
 
-    SLAYRADIO = "http://relay3.slayradio.org:8000/"
-    DUBSTEP = [
-        "https://www.youtube.com/watch?v=dLyH94jNau0",
-        "https://www.youtube.com/watch?v=RRucF7ffPRE",
-        "https://www.youtube.com/watch?v=nXaMKZApYDM"
-    ]
-    SCRATCH = "shortscratch.wav"
+GAP_SECONDS = metrics.histogram(
+    'mp3printer_transition_gap_seconds',
+    'Silence between the end of a track and the next one playing'
+)
 
-    def __init__(self, juggler, chromecast=None):
-        self._juggler = juggler
+# Plays through libvlc, locally or to a Chromecast. Player talks to its backend
+# through play/pause/stop/set_position/preload/start/set_volume, the getters
+# below and release, and the backend reports back through the on_end/on_error/
+# on_playing/on_paused methods of the events object it is given (see
+# simulation.py for another backend).
+class VlcBackend:
+    def __init__(self, events, chromecast=None):
+        import vlc
         instance_opts = ["--no-video"]
         self._media_opts = []
         if chromecast is not None:
@@ -23,73 +29,420 @@ class Player:
             self._media_opts.append(":demux-filter=demux_chromecast")
         self._instance = vlc.Instance(*instance_opts)
         self._mediaplayer = self._instance.media_player_new()
+        # VLC only keeps one callback per event type
         vlc_events = self._mediaplayer.event_manager()
-        vlc_events.event_attach(vlc.EventType.MediaPlayerEndReached, juggler.song_finished, 1)
-        vlc_events.event_attach(vlc.EventType.MediaPlayerEncounteredError, juggler.song_finished, 1)
-        self._playingDubstep = False
-        self._shouldPlayDubstep = (random.randint(0, 1) == 1)
-        self.play_fallback()
+        vlc_events.event_attach(vlc.EventType.MediaPlayerEndReached, lambda e: events.on_end())
+        vlc_events.event_attach(vlc.EventType.MediaPlayerEncounteredError, lambda e: events.on_error())
+        vlc_events.event_attach(vlc.EventType.MediaPlayerPlaying, lambda e: events.on_playing())
+        vlc_events.event_attach(vlc.EventType.MediaPlayerPaused, lambda e: events.on_paused())
 
     def release(self):
         self._mediaplayer.stop()
         self._instance.release()
 
+    def play(self, mrl):
+        self._mediaplayer.set_mrl(mrl, *self._media_opts)
+        self._mediaplayer.play()
+
+    def pause(self):
+        self._mediaplayer.pause()
+
+    def stop(self):
+        self._mediaplayer.stop()
+
+    def set_position(self, position):
+        self._mediaplayer.set_position(position)
+
+    def get_position(self):
+        return self._mediaplayer.get_position()
+
+    def get_time(self):
+        return self._mediaplayer.get_time()
+
+    def get_length(self):
+        return self._mediaplayer.get_length()
+
+    def is_playing(self):
+        return bool(self._mediaplayer.is_playing())
+
+    # Opens and buffers mrl, but holds it paused until start()
+    def preload(self, mrl):
+        self._mediaplayer.set_mrl(mrl, *self._media_opts, ":start-paused")
+        self._mediaplayer.play()
+
+    def start(self):
+        self._mediaplayer.set_pause(0)
+
+    def set_volume(self, volume):
+        self._mediaplayer.audio_set_volume(volume)
+
+# Tells Player which of its backends an event came from
+class _BackendEvents:
+    def __init__(self, player):
+        self._player = player
+        self.backend = None
+        self.level = 100        # Full volume for the backend's track
+
+    def on_end(self):
+        self._player.on_end(self)
+
+    def on_error(self):
+        self._player.on_error(self)
+
+    def on_playing(self):
+        self._player.on_playing(self)
+
+    def on_paused(self):
+        self._player.on_paused(self)
+
+# Plays the queue through one backend, while a second one (the standby) has
+# the next track loaded and buffered, so switching tracks is just a swap.
+class Player:
+
+    SLAYRADIO = "http://relay3.slayradio.org:8000/"
+    DUBSTEP = [
+        "https://www.youtube.com/watch?v=dLyH94jNau0",
+        "https://www.youtube.com/watch?v=RRucF7ffPRE",
+        "https://www.youtube.com/watch?v=nXaMKZApYDM"
+    ]
+    SCRATCH = "shortscratch.wav"
+    # Pre-resolved stream URLs must stay valid at least this long to be used
+    MIN_VALID = 30
+    FADE_STEP = 0.1
+
+    def __init__(self, juggler, resolver, prefetcher=None, chromecast=None, backend=VlcBackend, crossfade=0, probe_fallback=True):
+        self.lock = RLock()
+        self._juggler = juggler
+        self._resolver = resolver
+        self._prefetcher = prefetcher
+        self._ended_at = None
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'gapless': 0,
+            'transitions': 0,
+            'gap_last': 0.0,
+            'gap_max': 0.0,
+            'gap_total': 0.0,
+        }
+        # Two players would both cast to the Chromecast, so that gets one
+        self._slots = []
+        for i in range(1 if chromecast is not None else 2):
+            events = _BackendEvents(self)
+            events.backend = backend(events, chromecast)
+            self._slots.append(events)
+        self._active = self._slots[0]
+        self._standby = self._slots[1] if len(self._slots) > 1 else None
+        self._standby_id = None
+        self._standby_ready = False
+        self._preloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preload')
+        self._crossfade = crossfade if self._standby is not None else 0
+        self._fading = False
+        self._fading_out = None # The slot whose track is fading out
+        self._running = True
+        if self._crossfade > 0:
+            Thread(target=self._watch_fade, args=(), daemon=True).start()
+        self._playingDubstep = False
+        self._shouldPlayDubstep = (random.randint(0, 1) == 1)
+        self._dubstepTrack = 0
+        self._fallback = None   # The fallback source playing, if any
+        self._idle = False      # Nothing to play, not even a fallback
+        self._warmer = FallbackWarmer(resolver, self.DUBSTEP, [self.SLAYRADIO], probe=probe_fallback)
+        self._warmer.start()
+
+    @property
+    def _backend(self):
+        return self._active.backend
+
+    def release(self):
+        self._running = False
+        self._warmer.stop()
+        self._preloader.shutdown(wait=False, cancel_futures=True)
+        for slot in self._slots:
+            slot.backend.release()
+
     def _handleDubstep(self):
+        self._fallback = None
+        self._idle = False
         self._playingDubstep = False
         self._shouldPlayDubstep = not self._shouldPlayDubstep
 
+    def stats(self):
+        stats = dict(self._stats)
+        stats['gap_avg'] = stats['gap_total'] / max(stats['transitions'], 1)
+        for key, value in self._warmer.stats().items():
+            stats['fallback_' + key] = value
+        return stats
+
+    # Backend events, called from whatever thread the backend uses. Only the
+    # active backend's events matter, the standby is just warming up.
+    def on_end(self, events):
+        # The track fading out already counts as finished, but the one
+        # fading in may be shorter than the fade
+        if events is not self._active or events is self._fading_out:
+            return
+        self._ended_at = time.monotonic()
+        self._juggler.song_finished()
+
+    def on_error(self, events):
+        if events is self._standby:
+            self._standby_id = None
+            self._standby_ready = False
+        elif events is self._active:
+            if self._fallback is not None:
+                self._warmer.mark_dead(self._fallback)
+            self._juggler.song_finished()
+
+    def on_paused(self, events):
+        if events is self._active:
+            self._juggler.playback_changed()
+
+    def on_playing(self, events):
+        if events is not self._active:
+            return
+        if self._ended_at is not None:
+            gap = max(time.monotonic() - self._ended_at, 0)
+            self._ended_at = None
+            self._stats['transitions']+= 1
+            self._stats['gap_last'] = gap
+            self._stats['gap_max'] = max(self._stats['gap_max'], gap)
+            self._stats['gap_total']+= gap
+            GAP_SECONDS.observe(gap)
+        self._juggler.playback_changed()
+
     def _get_link_url(self, link):
-        ydl_opts = {
-            'quiet': True,
-            'format': 'bestaudio/best'
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(link, download=False)
-            return info_dict.get("url", None)
+        # Usually resolved ahead of time by the juggler's LookAhead
+        info_dict = self._resolver.cached(link, self.MIN_VALID)
+        if info_dict is not None:
+            self._stats['hits']+= 1
+        else:
+            self._stats['misses']+= 1
+            info_dict = self._resolver.resolve(link, self.MIN_VALID).result()
+        return info_dict.get("url", None)
+
+    def _track_mrl(self, track):
+        mrl = track['mrl']
+        if track['type'] == 'link':
+            path = None
+            if self._prefetcher is not None:
+                path = self._prefetcher.lookup(mrl)
+            mrl = path if path is not None else self._get_link_url(mrl)
+        return mrl
+
+    # The volume that applies a track's loudness gain (see loudness.py),
+    # libvlc takes up to 200
+    def _level(self, track):
+        return min(int(round(100 * 10**(track.get('gain_db', 0) / 20))), 200)
+
+    def _play_mrl(self, mrl, level=100):
+        if self._fading_out is not None and self._fading_out is not self._active:
+            # Cut short a fade still going on the standby
+            self._fading_out.backend.stop()
+            self._fading_out.backend.set_volume(100)
+        self._fading_out = None
+        self._fading = False
+        self._active.level = level
+        self._backend.set_volume(level)
+        self._backend.play(mrl)
+
+    # The gain of track was measured, applies it if it is waiting on the
+    # standby. A playing track keeps its volume, a jump would be worse.
+    def gain_changed(self, track):
+        self.lock.acquire()
+        try:
+            if self._standby is not None and self._standby_id == track['id'] and not self._fading:
+                self._standby.level = self._level(track)
+                self._standby.backend.set_volume(self._standby.level)
+        finally:
+            self.lock.release()
+
+    # Loads track into the standby backend, to be swapped in by play()
+    def preload(self, track):
+        if self._standby is None:
+            return
+        track_id = track['id'] if track is not None else None
+        self.lock.acquire()
+        try:
+            if track_id == self._standby_id:
+                return
+            self._standby_id = track_id
+            self._standby_ready = False
+        finally:
+            self.lock.release()
+        if track is not None:
+            self._preloader.submit(self._preload, track)
+
+    def _preload(self, track):
+        try:
+            mrl = self._track_mrl(track)
+            # Don't cut off a track that is still fading out on the standby
+            while self._fading and self._running:
+                time.sleep(self.FADE_STEP)
+            self.lock.acquire()
+            try:
+                if self._standby_id == track['id']:
+                    self._standby.level = self._level(track)
+                    self._standby.backend.set_volume(self._standby.level)
+                    self._standby.backend.preload(mrl)
+                    self._standby_ready = True
+            finally:
+                self.lock.release()
+        except Exception as err:
+            print('Could not preload %s: %s' % (track['filename'], err))
+
+    def _swap(self):
+        # Must be called with the lock held
+        old, new = self._active, self._standby
+        self._active, self._standby = new, old
+        self._standby_id = None
+        self._standby_ready = False
+        self._stats['gapless']+= 1
+        if self._fading:
+            new.backend.set_volume(0)
+            new.backend.start()
+            Thread(target=self._fade, args=(old, new)).start()
+        else:
+            old.backend.stop()
+            new.backend.set_volume(new.level)
+            new.backend.start()
+
+    def _watch_fade(self):
+        # Ends the track a little early when the next one is ready to fade in
+        while self._running:
+            time.sleep(self.FADE_STEP)
+            if self._fading or not self._standby_ready or not self._backend.is_playing():
+                continue
+            # A next track shorter than the fade just follows gaplessly
+            incoming = self._standby.backend.get_length()
+            if 0 < incoming <= self._crossfade*1000:
+                continue
+            remaining = self._backend.get_length() - self._backend.get_time()
+            if 0 < remaining <= self._crossfade*1000:
+                self._fading_out = self._active
+                self._fading = True
+                self._ended_at = time.monotonic()
+                self._juggler.song_finished()
 
-    def _play_mrl(self, mrl):
-       self._mediaplayer.set_mrl(mrl, *self._media_opts)
-       self._mediaplayer.play()
+    def _fade(self, old, new):
+        steps = max(int(self._crossfade / self.FADE_STEP), 1)
+        for step in range(1, steps + 1):
+            time.sleep(self.FADE_STEP)
+            if self._fading_out is not old:
+                return      # Cut short by _play_mrl
+            new.backend.set_volume(int(new.level * step / steps))
+            old.backend.set_volume(int(old.level * (steps - step) / steps))
+        old.backend.stop()
+        old.backend.set_volume(100)
+        self._fading_out = None
+        self._fading = False
+
+    # The mrl to play track with, None if the standby has it ready. May wait
+    # for yt-dlp, so the juggler calls this without holding its lock.
+    def prepare(self, track):
+        self.lock.acquire()
+        try:
+            if self._standby_ready and self._standby_id == track['id']:
+                return None
+        finally:
+            self.lock.release()
+        return self._track_mrl(track)
 
-    def play(self, track):
+    # Plays track from mrl (see prepare), returns False if that turned out
+    # to need the standby, which is no longer ready, so prepare again.
+    def play(self, track, mrl=None):
         try:
+            self.lock.acquire()
+            try:
+                if self._standby_ready and self._standby_id == track['id']:
+                    self._handleDubstep()
+                    print("Now playing: "+track['filename'])
+                    self._swap()
+                    return True
+            finally:
+                self.lock.release()
+            if mrl is None:
+                return False
             self._handleDubstep()
             print("Now playing: "+track['filename'])
-            mrl = track['mrl']
-            if track['type'] == 'link':
-                mrl = self._get_link_url(mrl)
-            self._play_mrl(mrl)
+            self._play_mrl(mrl, self._level(track))
         except Exception as err:
             print(err)
             self._juggler.song_finished()
+        return True
 
     def pause(self):
-        self._mediaplayer.pause()
+        self._backend.pause()
 
     def scratch(self):
         self._handleDubstep()
         self._play_mrl(self.SCRATCH)
 
     def get_position(self):
-        return self._mediaplayer.get_position()
+        return self._backend.get_position()
+
+    def get_time(self):
+        return self._backend.get_time()
+
+    def get_length(self):
+        return self._backend.get_length()
+
+    def is_playing(self):
+        return self._backend.is_playing()
 
+    def _retry_fallback(self):
+        if self._running and self._idle:
+            self._juggler.song_finished()
+
+    # The next dubstep track that is alive and resolved, as (track, url, position)
+    def _ready_dubstep(self):
+        if self._playingDubstep:
+            first = self._dubstepTrack + 1
+            position = 0
+        else:
+            first = random.randint(0, len(self.DUBSTEP) - 1)
+            position = random.random()
+        for i in range(len(self.DUBSTEP)):
+            track = (first + i) % len(self.DUBSTEP)
+            link = self.DUBSTEP[track]
+            if not self._warmer.alive(link):
+                continue
+            info_dict = self._resolver.cached(link, self.MIN_VALID)
+            if info_dict is not None and info_dict.get("url") is not None:
+                return track, info_dict["url"], position
+        return None
+
+    # Plays whichever fallback is ready right now, the FallbackWarmer keeps
+    # them resolved and checked so this never waits for yt-dlp or a dead relay.
     def play_fallback(self):
         try:
-            if self._shouldPlayDubstep:
-                if self._playingDubstep:
-                    self._dubstepTrack = (self._dubstepTrack + 1) % len(self.DUBSTEP)
-                    position = 0
-                else:
-                    self._dubstepTrack = random.randint(0, len(self.DUBSTEP) - 1)
-                    position = random.random()
+            self._idle = False
+            dubstep = self._ready_dubstep()
+            radio = self._warmer.alive(self.SLAYRADIO)
+            if dubstep is not None and (self._shouldPlayDubstep or not radio):
+                track, url, position = dubstep
+                self._dubstepTrack = track
                 self._playingDubstep = True
+                self._fallback = self.DUBSTEP[track]
                 print("Now playing: Dubstep")
-                url = self._get_link_url(self.DUBSTEP[self._dubstepTrack])
                 self._play_mrl(url)
-                self._mediaplayer.set_position(position)
-            else:
+                self._backend.set_position(position)
+            elif radio:
+                self._playingDubstep = False
+                self._fallback = self.SLAYRADIO
                 print("Now playing: Slay radio")
                 self._play_mrl(self.SLAYRADIO)
+            else:
+                # Trying again right away would only fail again
+                self._playingDubstep = False
+                self._fallback = None
+                self._idle = True
+                print("No fallback available")
+                self._backend.stop()
+                timer = Timer(self._warmer.RETRY, self._retry_fallback)
+                timer.daemon = True
+                timer.start()
+                return
+            metrics.phase('fallback playing')
         except Exception as err:
             print(err)
             self._juggler.song_finished()
@@ -0,0 +1,207 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+# local libs
+from resolver import canonical_url
+
+# Downloads the audio of queued link tracks into a local cache directory, so
+# they play (and download) from disk instead of the remote host. Files are
+# named by their content hash, so links to the same audio share one file, and
+# the least recently used files are removed when the cache grows beyond its
+# budget, unless they are still queued. The directory may hold other files
+# too, only the index, hash named files and partial downloads are ours.
+class Prefetcher:
+    INDEX = 'index.json'
+    OWN_FILE = re.compile(r'^([0-9a-f]{64}(\.\w+)?|partial-[0-9a-f-]{36}(\..*)?)$')
+    # A link whose download failed is tried again after this many seconds
+    RETRY_FAILED = 600
+
+    def __init__(self, directory, budget, workers=2):
+        self.lock = Lock()
+        self._directory = directory
+        self._budget = budget
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._index = OrderedDict()     # Canonical URL -> file name, in LRU order
+        self._sizes = {}                # File name -> bytes
+        self._queued = OrderedDict()    # Canonical URL -> [link, times queued]
+        self._in_flight = set()
+        self._failed = {}               # Canonical URL -> time.monotonic() of the failure
+        self._stats = {'hits': 0, 'misses': 0, 'downloads': 0, 'errors': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['files'] = len(self._sizes)
+            stats['bytes'] = self._usage()
+            stats['budget'] = self._budget
+        finally:
+            self.lock.release()
+        return stats
+
+    def queued(self, link):
+        key = canonical_url(link)
+        self.lock.acquire()
+        try:
+            if key in self._queued:
+                self._queued[key][1]+= 1
+            else:
+                self._queued[key] = [link, 1]
+            self._pump()
+        finally:
+            self.lock.release()
+
+    def dequeued(self, link):
+        key = canonical_url(link)
+        self.lock.acquire()
+        try:
+            if key in self._queued:
+                self._queued[key][1]-= 1
+                if self._queued[key][1] <= 0:
+                    del(self._queued[key])
+                    self._failed.pop(key, None)
+                    self._evict()
+                    self._pump()
+        finally:
+            self.lock.release()
+
+    def lookup(self, link):
+        key = canonical_url(link)
+        self.lock.acquire()
+        try:
+            filename = self._index.get(key)
+            if filename is None:
+                self._stats['misses']+= 1
+                return None
+            self._stats['hits']+= 1
+            self._index.move_to_end(key)
+            return os.path.join(self._directory, filename)
+        finally:
+            self.lock.release()
+
+    def _usage(self):
+        return sum(self._sizes.values())
+
+    def _pump(self):
+        # Must be called with the lock held
+        now = time.monotonic()
+        for key, (link, count) in self._queued.items():
+            if len(self._in_flight) >= self._workers or self._usage() >= self._budget:
+                break
+            if key in self._failed and now - self._failed[key] < self.RETRY_FAILED:
+                continue
+            if key in self._index or key in self._in_flight:
+                continue
+            self._failed.pop(key, None)
+            self._in_flight.add(key)
+            self._executor.submit(self._download, key, link)
+
+    def _evict(self):
+        # Must be called with the lock held
+        for key in list(self._index):
+            if self._usage() <= self._budget:
+                break
+            if key in self._queued:
+                continue
+            filename = self._index.pop(key)
+            self._stats['evictions']+= 1
+            if filename not in self._index.values():
+                del(self._sizes[filename])
+                try:
+                    os.remove(os.path.join(self._directory, filename))
+                except OSError as err:
+                    print(err)
+        self._save_index()
+
+    def _download(self, key, link):
+        partial = os.path.join(self._directory, 'partial-' + str(uuid.uuid4()))
+        try:
+            import yt_dlp   # Slow to import, and not needed until now
+            ydl_opts = {
+                'quiet': True,
+                'format': 'bestaudio/best',
+                'outtmpl': partial + '.%(ext)s'
+            }
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info_dict = ydl.extract_info(link, download=True)
+                downloads = info_dict.get('requested_downloads')
+                path = downloads[0]['filepath'] if downloads else ydl.prepare_filename(info_dict)
+
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                chunk = f.read(1048576)
+                while chunk:
+                    sha.update(chunk)
+                    chunk = f.read(1048576)
+            filename = sha.hexdigest() + os.path.splitext(path)[-1]
+            os.replace(path, os.path.join(self._directory, filename))
+            size = os.path.getsize(os.path.join(self._directory, filename))
+
+            self.lock.acquire()
+            try:
+                self._in_flight.discard(key)
+                self._stats['downloads']+= 1
+                self._index[key] = filename
+                self._sizes[filename] = size
+                self._evict()
+                self._pump()
+            finally:
+                self.lock.release()
+        except Exception as err:
+            print('Prefetch of %s failed: %s' % (link, err))
+            for path in glob.glob(glob.escape(partial) + '*'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.lock.acquire()
+            try:
+                self._in_flight.discard(key)
+                self._failed[key] = time.monotonic()
+                self._stats['errors']+= 1
+            finally:
+                self.lock.release()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self._directory, self.INDEX)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for key, filename in entries:
+            path = os.path.join(self._directory, filename)
+            if os.path.isfile(path):
+                self._index[key] = filename
+                self._sizes[filename] = os.path.getsize(path)
+        # Our files that aren't in the index are leftovers, e.g. partial downloads
+        for filename in os.listdir(self._directory):
+            if self.OWN_FILE.match(filename) and filename not in self._sizes:
+                try:
+                    os.remove(os.path.join(self._directory, filename))
+                except OSError:
+                    pass
+        self._evict()
+
+    def _save_index(self):
+        # Must be called with the lock held
+        path = os.path.join(self._directory, self.INDEX)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(list(self._index.items()), f)
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            print(err)
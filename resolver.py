@@ -0,0 +1,393 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock, Thread
+import time
+import urllib.parse
+import urllib.request
+
+# local libs
+import metrics
+
+EXTRACT_SECONDS = metrics.histogram(
+    'mp3printer_extract_info_seconds',
+    'Time spent in yt-dlp extract_info for a link'
+)
+
+# Query parameters that never change what a link points to
+TRACKING_PARAMS = ('si', 'feature', 'fbclid', 'gclid', 'pp')
+
+def canonical_url(link):
+    parts = urllib.parse.urlsplit(link.strip())
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path
+    query = [
+        (key, value) for key, value in urllib.parse.parse_qsl(parts.query)
+        if key not in TRACKING_PARAMS and not key.startswith('utm_')
+    ]
+    if host == 'youtu.be' and len(path) > 1:
+        host = 'youtube.com'
+        query.append(('v', path[1:]))
+        path = '/watch'
+    return urllib.parse.urlunsplit((
+        parts.scheme.lower(),
+        host,
+        path,
+        urllib.parse.urlencode(sorted(query)),
+        ''
+    ))
+
+# Direct media URLs (e.g. from YouTube) stop working after a while, and say
+# when in an 'expire' query parameter. Returns a time.monotonic() deadline.
+def stream_expiry(info_dict):
+    url = info_dict.get('url')
+    if url is None:
+        return None
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    try:
+        return time.monotonic() + float(query['expire'][0]) - time.time()
+    except (KeyError, ValueError):
+        return None
+
+def _is_playlist(info_dict):
+    return info_dict.get('_type') in ('playlist', 'multi_video')
+
+def _copy_future(source, target):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+# Runs yt-dlp extractions in a bounded pool, at most one per link at a time,
+# and keeps the results in an LRU cache for a while.
+class Resolver:
+
+    YDL_OPTS = {
+        'quiet': True,
+        'format': 'bestaudio/best'
+    }
+
+    def __init__(self, workers=4, cache_size=256, cache_ttl=1800):
+        self.lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver')
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._cache = OrderedDict()     # Canonical URL -> (expiry, info_dict)
+        self._in_flight = {}            # Canonical URL -> Future
+        self._stats = {'hits': 0, 'misses': 0, 'shared': 0, 'errors': 0}
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['cached'] = len(self._cache)
+            stats['in_flight'] = len(self._in_flight)
+        finally:
+            self.lock.release()
+        return stats
+
+    # min_valid is how many seconds a cached result (and its stream URL) must
+    # stay valid to be used, results closer to expiry are looked up again.
+    def cached(self, link, min_valid=0):
+        key = canonical_url(link)
+        self.lock.acquire()
+        try:
+            return self._lookup(key, min_valid)
+        finally:
+            self.lock.release()
+
+    # Returns a concurrent.futures.Future of the info_dict for link
+    def resolve(self, link, min_valid=0):
+        key = canonical_url(link)
+        self.lock.acquire()
+        try:
+            info_dict = self._lookup(key, min_valid)
+            if info_dict is not None:
+                self._stats['hits']+= 1
+                future = Future()
+                future.set_result(info_dict)
+                return future
+            if key in self._in_flight:
+                self._stats['shared']+= 1
+                return self._in_flight[key]
+            self._stats['misses']+= 1
+            future = self._executor.submit(self._extract, link)
+            self._in_flight[key] = future
+        finally:
+            self.lock.release()
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    # Calls on_entry(link, title) for each track of a playlist link, in order
+    # and as they are found, or just once for a link to a single track, and
+    # stops early if it returns False. Returns a concurrent.futures.Future of
+    # the number of tracks. The lookup is shared like resolve()'s: a cached
+    # single track is taken from the cache, and a link already being looked
+    # up waits for that, anything else is expanded on a worker (where
+    # on_entry is called).
+    def expand(self, link, on_entry):
+        key = canonical_url(link)
+        shared = None
+        self.lock.acquire()
+        try:
+            info_dict = self._lookup(key)
+            if info_dict is not None and not _is_playlist(info_dict):
+                self._stats['hits']+= 1
+            elif key in self._in_flight:
+                self._stats['shared']+= 1
+                shared = self._in_flight[key]
+            else:
+                self._stats['misses']+= 1
+                looked_up = Future()
+                self._in_flight[key] = looked_up
+        finally:
+            self.lock.release()
+        if info_dict is not None and not _is_playlist(info_dict):
+            future = Future()
+            on_entry(link, info_dict.get('title', None))
+            future.set_result(1)
+            return future
+        if shared is None:
+            looked_up.add_done_callback(lambda f: self._done(key, f))
+            try:
+                return self._executor.submit(self._expand, link, on_entry, looked_up)
+            except RuntimeError as err:
+                looked_up.set_exception(err)
+                raise
+
+        future = Future()
+        def resolved(shared):
+            try:
+                if shared.cancelled() or shared.exception() is not None or _is_playlist(shared.result()):
+                    # A playlist's entries are only seen by whoever expanded
+                    # it, and a failure is for this expansion to report
+                    expanded = self._executor.submit(self._expand, link, on_entry)
+                    expanded.add_done_callback(lambda f: _copy_future(f, future))
+                    return
+                on_entry(link, shared.result().get('title', None))
+                future.set_result(1)
+            except Exception as err:
+                future.set_exception(err)
+        shared.add_done_callback(resolved)
+        return future
+
+    # looked_up, if given, is the future in _in_flight for link, which gets
+    # the info_dict of a single track, or the flat one of a playlist
+    def _expand(self, link, on_entry, looked_up=None):
+        if looked_up is None:
+            looked_up = Future()
+            looked_up.add_done_callback(lambda f: self._done(canonical_url(link), f, looked_up))
+        try:
+            import yt_dlp
+        except Exception as err:
+            looked_up.set_exception(err)
+            raise
+        opts = dict(self.YDL_OPTS, extract_flat='in_playlist', lazy_playlist=True)
+        start = time.monotonic()
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            try:
+                info_dict = ydl.extract_info(link, download=False, process=False)
+                if not _is_playlist(info_dict):
+                    # A single track: finish looking it up, so playing it won't
+                    info_dict = ydl.process_ie_result(info_dict, download=False)
+            except Exception as err:
+                looked_up.set_exception(err)
+                raise
+            finally:
+                EXTRACT_SECONDS.observe(time.monotonic() - start)
+            looked_up.set_result(info_dict)
+            if not _is_playlist(info_dict):
+                on_entry(link, info_dict.get('title', None))
+                return 1
+            count = 0
+            # Flat entries are only links (and usually titles), and with a
+            # lazy playlist the later pages aren't even fetched yet
+            for entry in info_dict.get('entries') or []:
+                if entry is None:
+                    continue
+                url = entry.get('webpage_url') or entry.get('url')
+                if url is None:
+                    continue
+                if on_entry(url, entry.get('title') or url) is False:
+                    break
+                count+= 1
+            return count
+
+    def _lookup(self, key, min_valid=0):
+        # Must be called with the lock held
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[0] < now:
+            del(self._cache[key])
+            return None
+        if entry[0] < now + min_valid:
+            return None
+        self._cache.move_to_end(key)
+        return entry[1]
+
+    def _extract(self, link):
+        start = time.monotonic()
+        try:
+            import yt_dlp   # Slow to import, and not needed until now
+            with yt_dlp.YoutubeDL(self.YDL_OPTS) as ydl:
+                return ydl.extract_info(link, download=False)
+        finally:
+            EXTRACT_SECONDS.observe(time.monotonic() - start)
+
+    def _done(self, key, future, in_flight=None):
+        self.lock.acquire()
+        try:
+            # Leaves alone another lookup of key that was in flight first
+            if in_flight is None or self._in_flight.get(key) is in_flight:
+                self._in_flight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                self._stats['errors']+= 1
+                return
+            # A flat playlist from expand() is no use to anyone else
+            if not _is_playlist(future.result()):
+                self._store(key, future.result())
+        finally:
+            self.lock.release()
+
+    def _store(self, key, info_dict):
+        # Must be called with the lock held
+        expiry = time.monotonic() + self._cache_ttl
+        stream = stream_expiry(info_dict)
+        if stream is not None:
+            expiry = min(expiry, stream)
+        self._cache[key] = (expiry, info_dict)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+# Keeps the stream URLs of the next few link tracks in the queue resolved
+# (and re-resolved before they expire), so the player never has to wait.
+class LookAhead:
+    REFRESH = 60
+
+    def __init__(self, resolver, depth=3, margin=300):
+        self._resolver = resolver
+        self._depth = depth
+        self._margin = margin
+        self._links = []
+        self._event = Event()
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._refresh, args=())
+            self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._event.set()
+            self._thread.join()
+
+    def update(self, songlist):
+        links = [song['mrl'] for song in songlist.links(self._depth)]
+        if links != self._links:
+            self._links = links
+            self._event.set()
+
+    def _refresh(self):
+        while self._running:
+            for link in self._links:
+                self._resolver.resolve(link, self._margin)
+            self._event.wait(self.REFRESH)
+            self._event.clear()
+
+# Keeps the fallback sources ready to play: links resolved (and re-resolved
+# before their stream URLs expire) and radio streams checked to be up. A
+# source that fails is left alone for RETRY seconds, so the player can skip it.
+class FallbackWarmer:
+    REFRESH = 60
+    RETRY = 120
+    PROBE_TIMEOUT = 5
+
+    def __init__(self, resolver, links, streams, margin=300, probe=True):
+        self.lock = Lock()
+        self._resolver = resolver
+        self._links = list(links)
+        self._streams = list(streams)
+        self._margin = margin
+        self._probe_streams = probe
+        self._dead = {}     # Source -> time.monotonic() until it is tried again
+        self._event = Event()
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._refresh, args=(), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._event.set()
+
+    def alive(self, source):
+        self.lock.acquire()
+        try:
+            until = self._dead.get(source)
+            if until is not None and until < time.monotonic():
+                del(self._dead[source])
+                until = None
+            return until is None
+        finally:
+            self.lock.release()
+
+    def mark_dead(self, source):
+        print('Fallback source unavailable: %s' % source)
+        self.lock.acquire()
+        try:
+            self._dead[source] = time.monotonic() + self.RETRY
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        sources = self._links + self._streams
+        alive = sum(1 for source in sources if self.alive(source))
+        return {'alive': alive, 'dead': len(sources) - alive}
+
+    def _resolved(self, link, future):
+        if future.cancelled() or future.exception() is not None:
+            self.mark_dead(link)
+
+    def _probe(self, url):
+        # Radio relays answer with a never-ending body, a first byte will do
+        request = urllib.request.Request(url, headers={'Icy-MetaData': '0'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.PROBE_TIMEOUT) as response:
+                response.read(1)
+        except Exception:
+            self.mark_dead(url)
+
+    def _refresh(self):
+        while self._running:
+            for link in self._links:
+                if not self.alive(link):
+                    continue
+                try:
+                    future = self._resolver.resolve(link, self._margin)
+                except RuntimeError:    # The resolver has been stopped
+                    return
+                future.add_done_callback(lambda f, link=link: self._resolved(link, f))
+            if self._probe_streams:
+                for url in self._streams:
+                    if self._running and self.alive(url):
+                        self._probe(url)
+            self._event.wait(self.REFRESH)
+            self._event.clear()
@@ -0,0 +1,228 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Timer
+import time
+import urllib.parse
+
+# A playback backend for Player that plays nothing, it only keeps a clock and
+# reports the same events VlcBackend does. Lets the server run headless, e.g.
+# for benchmarks/bench_server.py. Tracks last track_seconds, except sim://N
+# links (N seconds, as handed out by StubResolver) and .wav files (1 second).
+class SimulatedBackend:
+    def __init__(self, events, chromecast=None, track_seconds=180, start_delay=0.05):
+        self.lock = Lock()
+        self._events = events
+        self._track_seconds = track_seconds
+        self._start_delay = start_delay
+        self._timer = None
+        self._generation = 0    # Bumped whenever pending timers become stale
+        self._length = 0.0
+        self._offset = 0.0      # Seconds into the track when it last (re)started
+        self._started = None    # time.monotonic() of that, None when not playing
+        self.volume = 100
+
+    def _duration(self, mrl):
+        if mrl.startswith('sim://'):
+            return float(mrl[len('sim://'):])
+        if mrl.endswith('.wav'):
+            return 1.0
+        return self._track_seconds
+
+    def _schedule(self, delay, fn):
+        # Must be called with the lock held
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = Timer(delay, fn, args=(self._generation,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _elapsed(self):
+        if self._started is None:
+            return self._offset
+        return min(self._offset + time.monotonic() - self._started, self._length)
+
+    def release(self):
+        self.stop()
+
+    def play(self, mrl):
+        self.lock.acquire()
+        try:
+            self._generation+= 1
+            self._length = self._duration(mrl)
+            self._offset = 0.0
+            self._started = None
+            self._schedule(self._start_delay, self._on_start)
+        finally:
+            self.lock.release()
+
+    def preload(self, mrl):
+        self.lock.acquire()
+        try:
+            self._generation+= 1
+            self._length = self._duration(mrl)
+            self._offset = 0.0
+            self._started = None
+            if self._timer is not None:
+                self._timer.cancel()
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self._started is not None or self._length <= 0:
+                return
+            self._generation+= 1
+            self._started = time.monotonic()
+            self._schedule(self._length - self._offset, self._on_end)
+        finally:
+            self.lock.release()
+        self._events.on_playing()
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def pause(self):
+        self.lock.acquire()
+        try:
+            self._generation+= 1
+            if self._started is not None:
+                self._offset = self._elapsed()
+                self._started = None
+                if self._timer is not None:
+                    self._timer.cancel()
+                event = self._events.on_paused
+            elif 0 < self._length and self._offset < self._length:
+                self._started = time.monotonic()
+                self._schedule(self._length - self._offset, self._on_end)
+                event = self._events.on_playing
+            else:
+                return
+        finally:
+            self.lock.release()
+        event()
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self._generation+= 1
+            self._started = None
+            self._length = 0.0
+            self._offset = 0.0
+            if self._timer is not None:
+                self._timer.cancel()
+        finally:
+            self.lock.release()
+
+    def set_position(self, position):
+        self.lock.acquire()
+        try:
+            self._offset = position * self._length
+            if self._started is not None:
+                self._generation+= 1
+                self._started = time.monotonic()
+                self._schedule(self._length - self._offset, self._on_end)
+        finally:
+            self.lock.release()
+
+    def get_position(self):
+        self.lock.acquire()
+        try:
+            if self._length <= 0:
+                return -1
+            return self._elapsed() / self._length
+        finally:
+            self.lock.release()
+
+    def get_time(self):
+        self.lock.acquire()
+        try:
+            return int(self._elapsed() * 1000)
+        finally:
+            self.lock.release()
+
+    def get_length(self):
+        return int(self._length * 1000)
+
+    def is_playing(self):
+        return self._started is not None
+
+    # Timer callbacks, events are sent without the lock held since they call
+    # back into the juggler, which may be calling us with its own lock held.
+    def _on_start(self, generation):
+        self.lock.acquire()
+        try:
+            if generation != self._generation:
+                return
+            self._started = time.monotonic()
+            self._schedule(self._length - self._offset, self._on_end)
+        finally:
+            self.lock.release()
+        self._events.on_playing()
+
+    def _on_end(self, generation):
+        self.lock.acquire()
+        try:
+            if generation != self._generation:
+                return
+            self._offset = self._length
+            self._started = None
+        finally:
+            self.lock.release()
+        self._events.on_end()
+
+# Stands in for Resolver without touching the network: every link resolves
+# (after delay seconds) to its own URL as title and a sim:// stream.
+class StubResolver:
+    def __init__(self, track_seconds=180, delay=0, workers=4):
+        self._track_seconds = track_seconds
+        self._delay = delay
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stub-resolver')
+        self._stats = {'hits': 0, 'misses': 0, 'shared': 0, 'errors': 0}
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _info(self, link):
+        return {
+            'title': link,
+            'url': 'sim://%g' % self._track_seconds
+        }
+
+    def cached(self, link, min_valid=0):
+        if self._delay > 0:
+            return None
+        return self._info(link)
+
+    def resolve(self, link, min_valid=0):
+        if self._delay <= 0:
+            self._stats['hits']+= 1
+            future = Future()
+            future.set_result(self._info(link))
+            return future
+        self._stats['misses']+= 1
+        return self._executor.submit(self._slow_info, link)
+
+    # Every link is a single track, except ones with a ?playlist=N query,
+    # which are a playlist of N tracks
+    def expand(self, link, on_entry):
+        return self._executor.submit(self._expand, link, on_entry)
+
+    def _expand(self, link, on_entry):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(link).query)
+        if 'playlist' in query:
+            entries = ['%s#%d' % (link, i) for i in range(int(query['playlist'][0]))]
+        else:
+            entries = [link]
+        for count, entry in enumerate(entries):
+            if self._delay > 0:
+                time.sleep(self._delay)
+            if on_entry(entry, entry) is False:
+                return count
+        return len(entries)
+
+    def _slow_info(self, link):
+        time.sleep(self._delay)
+        return self._info(link)
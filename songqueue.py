@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import bisect
+import itertools
+
+# local libs
+from wire import Encodings
+
+# Counts queued songs per prio, and how many have a prio at or below a given
+# one, in O(log n) (a Fenwick tree, grown as higher prios show up).
+class _PrioCounter:
+    def __init__(self, size=16):
+        self._tree = [0] * (size + 1)
+
+    def add(self, prio, delta):
+        if prio + 1 >= len(self._tree):
+            self._grow(prio + 1)
+        i = prio + 1
+        while i < len(self._tree):
+            self._tree[i]+= delta
+            i+= i & -i
+
+    def count_upto(self, prio):
+        i = min(prio + 1, len(self._tree) - 1)
+        total = 0
+        while i > 0:
+            total+= self._tree[i]
+            i-= i & -i
+        return total
+
+    def _grow(self, needed):
+        size = len(self._tree) - 1
+        counts = [self.count_upto(p) - self.count_upto(p - 1) for p in range(size)]
+        while size < needed:
+            size*= 2
+        self._tree = [0] * (size + 1)
+        for prio, count in enumerate(counts):
+            if count:
+                self.add(prio, count)
+
+# The song queue. The head is the song currently playing, the rest are kept
+# in one bucket per prio, in the order they were added, so the queue order is
+# the same as inserting each song after all others of lower or equal prio.
+class SongQueue:
+    def __init__(self):
+        self._head = None
+        self._buckets = {}      # Prio -> OrderedDict of id -> song
+        self._prios = []        # Sorted prios that have a bucket
+        self._counter = _PrioCounter()
+        self._links = {}        # Prio -> OrderedDict of id -> link song, for links()
+        self._link_prios = []   # Sorted prios that have links
+        self._by_id = {}
+        self._by_upload = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __bool__(self):
+        return self._head is not None
+
+    def __iter__(self):
+        if self._head is not None:
+            yield self._head
+        for prio in list(self._prios):
+            yield from list(self._buckets[prio].values())
+
+    # A copy of the id -> song index, for QueueSnapshot
+    def tracks(self):
+        return dict(self._by_id)
+
+    def head(self):
+        return self._head
+
+    # The song that will play after the head
+    def next_up(self):
+        if not self._prios:
+            return None
+        return next(iter(self._buckets[self._prios[0]].values()))
+
+    def get(self, track_id):
+        return self._by_id.get(track_id)
+
+    def by_upload(self, upload_id):
+        return self._by_upload.get(upload_id)
+
+    # The first count link songs, in queue order, without going through the
+    # uploads in between
+    def links(self, count):
+        songs = []
+        if self._head is not None and self._head['type'] == 'link':
+            songs.append(self._head)
+        for prio in self._link_prios:
+            if len(songs) >= count:
+                break
+            songs.extend(itertools.islice(self._links[prio].values(), count - len(songs)))
+        return songs[:count]
+
+    # Adds song (which must have an 'id' and a 'prio') and returns its index
+    def insert(self, song):
+        self._by_id[song['id']] = song
+        if 'upload_id' in song and song['upload_id'] is not None:
+            self._by_upload[song['upload_id']] = song
+        if self._head is None:
+            self._head = song
+            return 0
+
+        prio = song['prio']
+        index = 1 + self._counter.count_upto(prio)
+        if prio not in self._buckets:
+            self._buckets[prio] = OrderedDict()
+            bisect.insort(self._prios, prio)
+        self._buckets[prio][song['id']] = song
+        self._counter.add(prio, 1)
+        if song['type'] == 'link':
+            if prio not in self._links:
+                self._links[prio] = OrderedDict()
+                bisect.insort(self._link_prios, prio)
+            self._links[prio][song['id']] = song
+        return index
+
+    # Removes a song, if it is the head the next one in line takes its place
+    def remove(self, song):
+        del(self._by_id[song['id']])
+        if self._by_upload.get(song.get('upload_id')) is song:
+            del(self._by_upload[song['upload_id']])
+        if song is self._head:
+            self._head = self._pop_first()
+        else:
+            self._take(song['prio'], song['id'])
+
+    def _pop_first(self):
+        if not self._prios:
+            return None
+        prio = self._prios[0]
+        return self._take(prio, next(iter(self._buckets[prio])))
+
+    def _take(self, prio, track_id):
+        bucket = self._buckets[prio]
+        song = bucket.pop(track_id)
+        self._counter.add(prio, -1)
+        if not bucket:
+            del(self._buckets[prio])
+            del(self._prios[bisect.bisect_left(self._prios, prio)])
+        links = self._links.get(prio)
+        if links is not None and links.pop(track_id, None) is not None and not links:
+            del(self._links[prio])
+            del(self._link_prios[bisect.bisect_left(self._link_prios, prio)])
+        return song
+
+# What readers see of the queue: the list message for clients, encoded at most
+# once per wire format, and the songs by id. Never changed once made, only replaced.
+class QueueSnapshot:
+    def __init__(self, message, tracks):
+        self.message = message
+        self.tracks = tracks
+        self.encodings = Encodings(message)
+
+    @property
+    def json(self):
+        return self.encodings.get('json')
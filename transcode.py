@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import os
+import shutil
+import subprocess
+
+# Extracts the audio of uploaded videos with ffmpeg, so a music video takes a
+# fraction of the disk space (and download bandwidth) while it is queued.
+# With bitrate 0 the audio is kept as it is (in Matroska, which takes any
+# codec), otherwise it is re-encoded to Opus at that many kbit/s. ffmpeg runs
+# as a process of its own, the pool's threads only wait for it.
+class AudioExtractor:
+    def __init__(self, ffmpeg='ffmpeg', bitrate=0, workers=2):
+        self.lock = Lock()
+        self._ffmpeg = shutil.which(ffmpeg)
+        if self._ffmpeg is None:
+            raise Exception('Could not find ffmpeg ("%s")' % ffmpeg)
+        self._bitrate = bitrate
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract')
+        self._stats = {'extracted': 0, 'errors': 0, 'bytes_saved': 0}
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self.lock.release()
+
+    # Future of the path of the extracted audio, next to path. The original
+    # is left alone.
+    def extract(self, path):
+        return self._executor.submit(self._extract, path)
+
+    def _extract(self, path):
+        if self._bitrate > 0:
+            target = os.path.splitext(path)[0] + '.audio.opus'
+            codec = ['-c:a', 'libopus', '-b:a', '%dk' % self._bitrate]
+        else:
+            target = os.path.splitext(path)[0] + '.audio.mka'
+            codec = ['-c:a', 'copy']
+        partial = target + '.partial'
+        try:
+            subprocess.run(
+                [self._ffmpeg, '-nostdin', '-loglevel', 'error', '-y', '-i', path,
+                    '-map', '0:a:0', '-vn', '-sn', '-dn'] + codec + ['-f', 'opus' if self._bitrate > 0 else 'matroska', partial],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True
+            )
+            os.replace(partial, target)
+        except Exception as err:
+            if isinstance(err, subprocess.CalledProcessError):
+                err = err.stderr.decode(errors='replace').strip() or err
+            print('Could not extract audio from %s: %s' % (path, err))
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            self.lock.acquire()
+            try:
+                self._stats['errors']+= 1
+            finally:
+                self.lock.release()
+            raise
+        self.lock.acquire()
+        try:
+            self._stats['extracted']+= 1
+            self._stats['bytes_saved']+= max(os.path.getsize(path) - os.path.getsize(target), 0)
+        finally:
+            self.lock.release()
+        return target
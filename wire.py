@@ -0,0 +1,50 @@
+import json
+
+# How messages are encoded for websocket clients. A client picks a format
+# with ?format= when it connects:
+#
+#   json      The messages as they are.
+#   compact   Queue lists (and batches of inserts) as columns and rows, so
+#             the keys aren't repeated for every track, without whitespace.
+
+FORMATS = ('json', 'compact')
+COLUMNS = ('id', 'filename', 'nick', 'address', 'prio')
+
+def _row(item):
+    return [item[column] for column in COLUMNS]
+
+def compact(message):
+    if message.get('type') == 'list':
+        return {
+            'type': 'list',
+            'version': message['version'],
+            'columns': COLUMNS,
+            'rows': [_row(item) for item in message['list']]
+        }
+    if message.get('type') == 'inserts':
+        return {
+            'type': 'inserts',
+            'version': message['version'],
+            'columns': ('index',) + COLUMNS,
+            'rows': [[insert['index']] + _row(insert['item']) for insert in message['items']]
+        }
+    return message
+
+def encode(message, format):
+    if format == 'compact':
+        return json.dumps(compact(message), separators=(',', ':'))
+    return json.dumps(message)
+
+# A message and its encodings, each made the first time it's needed
+class Encodings:
+    def __init__(self, message, encoded=None):
+        self.message = message
+        self._encoded = {}
+        if encoded is not None:
+            self._encoded['json'] = encoded
+
+    def get(self, format):
+        # Racing threads may both encode it, which is harmless
+        if format not in self._encoded:
+            self._encoded[format] = encode(self.message, format)
+        return self._encoded[format]